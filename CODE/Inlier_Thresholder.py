@@ -1,11 +1,15 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from stats import *
+from silhouette import silhouette_score_1d
 
 class Inlier_Thresholder:
 
     ########### initialize the object with the 1D array of values
-    def __init__(self, values, n_inliers=None, n_outliers=None, type="FM", alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 }):
+    def __init__(self, values, n_inliers=None, n_outliers=None, type="FM", alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 }, n_jobs=1):
+        self._cache = {}  # (method, alpha) -> (labels, threshold), emptied when values or alphas are reassigned
+        self.n_jobs = n_jobs  # number of threads used to evaluate the methods in use_best_method
         self.values = values
         self.threshold = None
         self.alphas=alphas
@@ -20,11 +24,63 @@ class Inlier_Thresholder:
         self.n_inliers = n_inliers
         self.n_outliers = n_outliers
 
+    ########### results are memoized: reassigning values or alphas empties the cache
+
+    @property
+    def values(self):
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = values
+        self._cache = {}
+
+    @property
+    def alphas(self):
+        return self._alphas
+
+    @alphas.setter
+    def alphas(self, alphas):
+        self._alphas = alphas
+        self._cache = {}
+
+    def _cache_key(self, method):
+        # the alpha is part of the key, so also an in-place change of the alphas dict gives a new entry
+        return method, self.alphas.get(method)
+
+    ########### evaluate all the methods once, concurrently if n_jobs > 1, filling the cache
+    def evaluate_methods(self, n_jobs=None):
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        to_run = [met for met in self.methods if self._cache_key(met) not in self._cache]
+
+        if n_jobs is not None and n_jobs > 1 and len(to_run) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(self._compute_inlier_threshold, to_run))
+        else:
+            results = [self._compute_inlier_threshold(met) for met in to_run]
+
+        for met, result in zip(to_run, results):
+            self._cache[self._cache_key(met)] = result
+
+        return {met: self.compute_inlier_threshold(met) for met in self.methods}
+
     ########### specify the method among the available ones and return the labels
     def compute_inlier_threshold(self, method):
 
         assert method in self.methods
-        
+
+        key = self._cache_key(method)
+        if key not in self._cache:
+            self._cache[key] = self._compute_inlier_threshold(method)
+
+        if self._cache[key] is None:
+            return
+
+        labels, threshold = self._cache[key]
+        # a copy, so that the caller can not modify the cached labels
+        return np.array(labels) if labels is not None else labels, threshold
+
+    def _compute_inlier_threshold(self, method):
         
         if method == "IQR":
             return interquantile_outlier(self.values)
@@ -56,10 +112,17 @@ class Inlier_Thresholder:
     ########### Majority voting ensemble
     def ensemble_inlier_thresholder(self):
 
+        key = ("Ensemble",) + tuple(self._cache_key(met) for met in self.methods)
+        if key not in self._cache:
+            self._cache[key] = self._ensemble_inlier_thresholder()
+
+        return np.array(self._cache[key])
+
+    def _ensemble_inlier_thresholder(self):
+
         L = []
 
-        for met in self.methods:
-            tmp, _ = self.compute_inlier_threshold(met)
+        for met, (tmp, _) in self.evaluate_methods().items():
             threshold = np.array(tmp)
             threshold[threshold == None] = 0.90
             L.append(threshold)
@@ -75,10 +138,12 @@ class Inlier_Thresholder:
     ############## Return the method that optimize the internal validation measure
     ############## Default is Silhouette: empirically the best one
 
-    def use_best_method(self, verbose=False, internal_validation_measure="Silhouette"):
+    def use_best_method(self, verbose=False, internal_validation_measure="Silhouette", n_jobs=None):
 
         assert internal_validation_measure in self.internal_validation_measures
 
+        results = self.evaluate_methods(n_jobs)
+
         score_sil = []  # score for the silhouette
 
         score_sep = []  # score for the separation BSS
@@ -88,14 +153,14 @@ class Inlier_Thresholder:
         thresh=[]
 
         for met in self.methods:
-            lab, _ = self.compute_inlier_threshold(met)
+            lab, _ = results[met]
             thresh.append(_)
 
             if len(np.unique(lab)) == 1:
                 score_sil.append(0), score_sep.append(0)
             else:
 
-                silhouette_avg = silhouette_score(self.values.reshape(-1, 1), lab)
+                silhouette_avg = silhouette_score_1d(self.values, lab)
                 wss, bss = compute_wss_bss(self.values, lab)
 
                 score_sil.append(silhouette_avg)
@@ -108,7 +173,7 @@ class Inlier_Thresholder:
         if len(np.unique(lab)) == 1:
             score_sil.append(0), score_sep.append(0)
         else:
-            silhouette_avg = silhouette_score(self.values.reshape(-1, 1), lab)
+            silhouette_avg = silhouette_score_1d(self.values, lab)
             wss, bss = compute_wss_bss(self.values, lab)
 
             score_sil.append(silhouette_avg)
@@ -0,0 +1,237 @@
+import numpy as np
+
+from stats import *
+from stats import _d, _lerp, _sn_inner_medians, _pairwise_differences_percentile
+
+
+class Streaming_Thresholder:
+    """
+    Online counterpart of Inlier_Thresholder for residuals that arrive in batches (e.g. live correspondence streams).
+
+    The residuals are summarized by running moments (count, mean, sum of squared deviations) and by a mergeable quantile
+    sketch in the style of KLL: a hierarchy of compactors, level h holds values of weight 2^h. When a level is full it is
+    sorted and every other value (random offset) is promoted to the next level with double weight. Level capacities
+    decrease geometrically (factor 2/3) from the top, so the memory is O(k) whatever the length of the stream.
+    Two thresholders built on different workers are combined with merge.
+
+    Error bounds w.r.t. the exact methods of stats.py on the whole stream:
+      - as long as the stream fits in the sketch (at most k residuals, no compaction yet) all the thresholds are exactly
+        those of the batch methods, which are called on the stored residuals;
+      - "Variance based": exact up to floating point rounding, the moments are not approximated;
+      - quantiles: a compaction at level h moves the rank of any value by at most 2^h, so the rank of a returned quantile
+        is off by at most rank_error()[0] * count positions (deterministic bound, tracked during the run). Since the
+        offsets are random the errors cancel out and with probability 1 - delta the rank error is below
+        rank_error(delta)[1] * count (Hoeffding bound), in practice below count / k;
+      - "IQR": Q1 and Q3 are exact quantiles of ranks 25% and 75% +- eps, with eps the normalized rank error above;
+      - "Median AD": the median is the exact quantile of rank 50% +- eps, the MAD is the exact median +- 2 eps of the
+        absolute deviations from that median (every interval count is the difference of two ranks);
+      - "Rosseeuw SN", "Rosseeuw QN": the estimators are computed on grid_size quantiles of the sketch (rank error
+        eps + 1 / grid_size), with the finite sample corrections of the real count. There is no closed form bound, but
+        they are medians / quartiles of distances between quantiles that are off by at most eps in rank.
+    """
+
+    METHODS = ["Median AD", "Rosseeuw SN", "Rosseeuw QN", "IQR", "Variance based"]
+
+    def __init__(self, k=200, type="FM", alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 },
+                 grid_size=1000, seed=None):
+        """
+        Args:
+        k: capacity of the top compactor, the rank error is ~ 1 / k
+        type: "FM" or "H", selects the methods as in Inlier_Thresholder
+        alphas: number of scale estimates over the location for the thresholds, as in Inlier_Thresholder
+        grid_size: number of quantiles used for the Sn and Qn estimators once the sketch is approximate
+        seed: seed of the random offsets of the compactions
+        """
+        assert k >= 2
+        self.k = k
+        self.alphas = alphas
+        self.grid_size = grid_size
+        self.rng = np.random.default_rng(seed)
+
+        if type == "FM":
+            self.methods = ["Median AD", "Rosseeuw SN", "Rosseeuw QN", "Variance based"]
+        if type == "H":
+            self.methods = ["Median AD", "Rosseeuw SN", "Rosseeuw QN", "IQR", "Variance based"]
+
+        # running moments
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+
+        # quantile sketch: levels[h] holds the values of weight 2^h, level 0 in arrival order
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.compactions = 0
+        self._error_sum = 0.0  # sum of the weights of the compactions: deterministic rank error bound
+        self._error_sq = 0.0  # sum of the squared weights: variance of the rank error
+
+    ########### moments
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def _add_moments(self, count, mean, m2):
+        # Chan et al. parallel update
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    ########### sketch
+
+    def _capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def _compress(self):
+        while sum(len(level) for level in self.levels) > sum(self._capacity(h) for h in range(len(self.levels))):
+            h = next(h for h in range(len(self.levels)) if len(self.levels[h]) >= self._capacity(h))
+            if h == len(self.levels) - 1:
+                self.levels.append(np.empty(0, dtype=np.float64))
+
+            values = np.sort(self.levels[h])
+            start = len(values) % 2  # with an odd number of values the smallest one stays at this level
+            offset = self.rng.integers(2)
+
+            self.levels[h] = values[:start]
+            self.levels[h + 1] = np.concatenate((self.levels[h + 1], values[start + offset::2]))
+
+            self.compactions += 1
+            self._error_sum += 2 ** h
+            self._error_sq += 4 ** h
+
+    def is_exact(self):
+        """True while no residual has been compacted: the thresholds are those of the batch methods."""
+        return self.compactions == 0
+
+    def update(self, batch):
+        """Add a batch of residuals to the stream."""
+        batch = np.asarray(batch, dtype=np.float64).ravel()
+        if len(batch) == 0:
+            return self
+
+        self._add_moments(len(batch), np.mean(batch), np.sum((batch - np.mean(batch)) ** 2))
+        self.levels[0] = np.concatenate((self.levels[0], batch))
+        self._compress()
+
+        return self
+
+    def merge(self, other):
+        """Merge in place the summary of another thresholder (e.g. built by another worker) with the same k."""
+        assert self.k == other.k
+
+        self._add_moments(other.count, other.mean, other.m2)
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], level))
+
+        self.compactions += other.compactions
+        self._error_sum += other._error_sum
+        self._error_sq += other._error_sq
+        self._compress()
+
+        return self
+
+    def rank_error(self, delta=0.01):
+        """
+        Normalized rank error of the quantiles of the sketch.
+
+        Returns:
+        bound: deterministic bound, the returned quantiles are off by at most bound * count ranks
+        probable: with probability 1 - delta the quantiles are off by at most probable * count ranks
+        """
+        if self.count == 0:
+            return 0.0, 0.0
+        return self._error_sum / self.count, min(np.sqrt(2 * self._error_sq * np.log(2 / delta)), self._error_sum) / self.count
+
+    def _items(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        return values, weights
+
+    ########### quantiles
+
+    @staticmethod
+    def _weighted_percentile(values, weights, q):
+        # np.percentile (linear) of the multiset in which every value is repeated weight times
+        order = np.argsort(values, kind="stable")
+        values, cum = values[order], np.cumsum(weights[order])
+
+        index = np.asarray(q, dtype=np.float64) / 100 * (cum[-1] - 1)
+        below = np.floor(index)
+        a = values[np.searchsorted(cum, below, side="right")]
+        b = values[np.searchsorted(cum, np.minimum(below + 1, cum[-1] - 1), side="right")]
+
+        return _lerp(a, b, index - below)
+
+    def quantile(self, q):
+        """Percentile(s) q in [0, 100] of the stream, np.percentile while the sketch is exact."""
+        if self.is_exact():
+            return np.percentile(self.levels[0], q)
+        return self._weighted_percentile(*self._items(), q)
+
+    def _grid(self):
+        # grid_size quantiles at the mid ranks, a sample that represents the stream for the pairwise estimators
+        m = min(self.count, self.grid_size)
+        values, weights = self._items()
+        order = np.argsort(values, kind="stable")
+        ranks = np.floor((np.arange(m) + 0.5) * self.count / m)
+        return values[order][np.searchsorted(np.cumsum(weights[order]), ranks, side="right")]
+
+    ########### thresholds
+
+    def threshold(self, method):
+        """Threshold of the given method on the residuals seen so far (None on an empty stream)."""
+        assert method in self.METHODS
+        if self.count == 0:
+            return
+
+        alpha = self.alphas.get(method)
+
+        if self.is_exact():
+            values = self.levels[0]
+            if method == "IQR":
+                return interquantile_outlier(values)[1]
+            if method == "Median AD":
+                return Median_Absolute_Deviation(values, alpha=alpha)[1]
+            if method == "Variance based":
+                return Variance_based(values, alpha=alpha)[1]
+            if method == "Rosseeuw SN":
+                return rousseeuwcroux_SN(values, alpha=alpha)[1]
+            if method == "Rosseeuw QN":
+                return rousseeuwcroux_QN(values, alpha=alpha)[1]
+
+        if method == "Variance based":
+            return self.mean + alpha * self.std
+
+        median = self.quantile(50)
+
+        if method == "IQR":
+            Q1, Q3 = self.quantile([25, 75])
+            return Q3 + 1.5 * (Q3 - Q1)
+
+        if method == "Median AD":
+            values, weights = self._items()
+            mad = self._weighted_percentile(np.abs(values - median), weights, 50) / 0.6744897501960817  # scale='normal'
+            return median + alpha * mad
+
+        grid = self._grid()
+        if method == "Rosseeuw SN":
+            std_est = c(self.count) * 1.1926 * np.median(_sn_inner_medians(grid))
+        else:
+            std_est = _d(self.count) * 2.2219 * _pairwise_differences_percentile(grid, 25)
+
+        return median + alpha * std_est
+
+    def thresholds(self):
+        """Thresholds of all the methods of the thresholder."""
+        return {met: self.threshold(met) for met in self.methods}
+
+    def labels(self, values, method):
+        """Labels (1 outlier, 0 inlier) of a batch of residuals w.r.t. the current threshold of the method."""
+        upper = self.threshold(method)
+        return abs((np.asarray(values) < upper).astype(int) - 1)
@@ -0,0 +1,266 @@
+"""Benchmarks of the stats and residual hot paths, on the AdelaideRMF scenes of DATASET and on synthetic inputs of
+increasing size. For every function it reports the time (best of --repeat runs), the peak memory traced by tracemalloc
+(numpy buffers included, OpenCV internal allocations excluded) and the scaling exponent b of time ~ n^b fitted on the
+synthetic sizes.
+
+Usage:
+    python benchmark.py                                          # print the results
+    python benchmark.py --save-baseline benchmark_baseline.json  # store them as the baseline
+    python benchmark.py --baseline benchmark_baseline.json       # flag the regressions against the baseline (exit code 1)
+    python benchmark.py --only rousseeuwcroux_QN forward_search --sizes 100 1000 10000 --scenes unihouse
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.io as spi
+
+from stats import *
+from utils import *
+from Inlier_Thresholder import Inlier_Thresholder
+from dataset_runner import DATASET_DIR, list_scenes
+
+
+SIZES = [100, 1000, 10000, 100000]
+
+# a regression is flagged when both the relative and the absolute increase are above the tolerances: timings of a
+# few microseconds are too noisy to be compared in relative terms
+TIME_TOLERANCE = 0.25
+MIN_TIME_DIFFERENCE = 1e-3  # seconds
+MEMORY_TOLERANCE = 0.25
+EXPONENT_TOLERANCE = 0.2
+
+
+######## Synthetic inputs
+
+def synthetic_scene(n, type='H', n_models=3, outlier_ratio=0.1, noise=0.5, seed=0):
+    """Scene in the format of the .mat files of the dataset with n correspondences: n_models random homographies (type H)
+    or random camera motions of a 3D point cloud (type FM), plus uniformly distributed outliers (label 0)."""
+    rng = np.random.default_rng(seed)
+    n_outliers = int(n * outlier_ratio)
+    labels = np.concatenate((np.zeros(n_outliers, dtype=int), rng.integers(1, n_models + 1, n - n_outliers)))
+
+    src = rng.uniform(0, 500, (n, 2))
+    dst = rng.uniform(0, 500, (n, 2))
+
+    for model in range(1, n_models + 1):
+        idx = np.where(labels == model)[0]
+        if type == 'H':
+            H = np.eye(3) + rng.normal(0, [[0.05, 0.05, 20], [0.05, 0.05, 20], [1e-5, 1e-5, 0]])
+            dst[idx] = projectiveTransform(src[idx], H).reshape(-1, 2)
+        else:
+            K = np.array([[500, 0, 250], [0, 500, 250], [0, 0, 1]])
+            X = np.column_stack((rng.uniform(-1, 1, (len(idx), 2)), rng.uniform(4, 8, len(idx))))
+            R, _ = cv2.Rodrigues(rng.normal(0, 0.1, 3))
+            t = np.array([1.0, rng.normal(0, 0.2), rng.normal(0, 0.2)])
+            x1, x2 = X @ K.T, (X @ R.T + t) @ K.T
+            src[idx], dst[idx] = x1[:, :2] / x1[:, 2:], x2[:, :2] / x2[:, 2:]
+        dst[idx] += rng.normal(0, noise, (len(idx), 2))
+
+    ones = np.ones(n)
+    image = np.zeros((500, 500, 3), dtype=np.uint8)
+
+    return {"data": np.vstack((src.T, ones, dst.T, ones)), "label": labels.reshape(1, -1), "img1": image, "img2": image}
+
+
+def synthetic_residuals(n, outlier_ratio=0.1, seed=0):
+    """Sorted residual curve: half normal inliers and uniformly distributed outliers."""
+    rng = np.random.default_rng(seed)
+    n_outliers = int(n * outlier_ratio)
+    return np.sort(np.concatenate((np.abs(rng.normal(0, 1, n - n_outliers)), rng.uniform(3, 30, n_outliers))))
+
+
+def synthetic_residual_matrix(n, n_models=4, seed=0):
+    """(n, n_models) residual matrix: every point is close to one model and far from the others."""
+    rng = np.random.default_rng(seed)
+    residual_matrix = rng.uniform(5, 50, (n, n_models))
+    residual_matrix[np.arange(n), rng.integers(0, n_models, n)] = np.abs(rng.normal(0, 1, n))
+    return residual_matrix
+
+
+######## Benchmarked functions: each one takes a single input, built (and not timed) from a synthetic size or from a scene
+######## of the dataset. Scene builders return None when the input does not apply to the type (H or FM) of the scene.
+
+def _scene_model(data, type):
+    # points of the whole scene and the model fitted with LMEDS on the points of the first model
+    points = extract_points(vi.group_models(data)["models"], data)
+    src, dst = points[0]["src_points"][0], points[0]["dst_points"][0]
+    M, _ = verify_LMEDS_H(src, dst, verbose=False) if type == 'H' else verify_LMEDS_FM(src, dst, verbose=False)
+    return points[1], points[2], M
+
+
+INPUTS = {
+    "model H": (lambda n: _scene_model(synthetic_scene(n, 'H', n_models=1, outlier_ratio=0), 'H'),
+                lambda data, type: _scene_model(data, type) if type == 'H' else None),
+    "model FM": (lambda n: _scene_model(synthetic_scene(n, 'FM', n_models=1, outlier_ratio=0), 'FM'),
+                 lambda data, type: _scene_model(data, type) if type == 'FM' else None),
+    "scene": (lambda n: (synthetic_scene(n), 'H'),
+              lambda data, type: (data, type)),
+    "residual matrix": (synthetic_residual_matrix,
+                        lambda data, type: build_residual_matrix(data, verbose=False, type=type)),
+    "residual curve": (synthetic_residuals,
+                       lambda data, type: compute_inliers_residual_curve(data, type=type, verbose=False)[0]),
+}
+
+BENCHMARKS = {
+    "compute_sampson_distance": (lambda model: compute_sampson_distance(*model), "model FM"),
+    "compute_SED": (lambda model: compute_SED(*model), "model FM"),
+    "compute_residual": (lambda model: compute_residual(*model), "model H"),
+    "build_residual_matrix": (lambda scene: build_residual_matrix(scene[0], verbose=False, type=scene[1]), "scene"),
+    "build_partition_matrix": (build_partition_matrix, "residual matrix"),
+    "Fuzzy_silhouette": (lambda res: Fuzzy_silhouette(res, build_partition_matrix(res)), "residual matrix"),
+    "rousseeuwcroux_SN": (rousseeuwcroux_SN, "residual curve"),
+    "rousseeuwcroux_QN": (rousseeuwcroux_QN, "residual curve"),
+    "forward_search": (forward_search, "residual curve"),
+    # a new thresholder at every run, otherwise the memoized results would be timed
+    "use_best_method": (lambda values: Inlier_Thresholder(values, type="H").use_best_method(), "residual curve"),
+}
+
+
+######## Measurements
+
+def measure(fn, repeat=3):
+    """Best time over repeat runs (seconds) and peak memory traced during one more run (bytes)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def scaling_exponent(sizes, times):
+    """Slope of the least squares line of log(time) vs log(n), time ~ n^exponent. Only the largest half of the sizes
+    (at least two) is used: on small inputs the fixed overheads hide the asymptotic behaviour."""
+    if len(sizes) < 2:
+        return None
+    order = np.argsort(sizes)[-max(2, (len(sizes) + 1) // 2):]
+    return float(np.polyfit(np.log(np.asarray(sizes)[order]), np.log(np.asarray(times)[order]), 1)[0])
+
+
+def run_benchmarks(names=None, sizes=SIZES, scenes=None, dataset_dir=DATASET_DIR, repeat=3, verbose=True):
+    """
+    Runs the benchmarks.
+
+    Args:
+      names : benchmarks to run, default all the keys of BENCHMARKS
+      sizes : sizes of the synthetic inputs
+      scenes : names of the scenes of the dataset (without .mat) to run, default all. An empty list skips the scenes
+      dataset_dir : folder containing adelH and adelFM
+      repeat : number of timed runs of every benchmark, the best one is kept
+
+    Returns:
+      report : dictionary {"machine": {...}, "results": {"name/input": {"time": s, "peak_memory": bytes, "n": n}},
+               "exponents": {name: exponent}}. The input is "synthetic-<n>" or "<H|FM>-<scene>"
+    """
+    names = list(BENCHMARKS) if names is None else names
+
+    loaded = []
+    for type in ("H", "FM"):
+        for path in list_scenes(dataset_dir, type):
+            scene = os.path.splitext(os.path.basename(path))[0]
+            if scenes is None or scene in scenes:
+                loaded.append((type, scene, spi.loadmat(path)))
+
+    results, exponents = {}, {}
+
+    for name in names:
+        function, kind = BENCHMARKS[name]
+        synthetic_input, scene_input = INPUTS[kind]
+
+        synthetic_times = []
+        for n in sizes:
+            t, peak = measure(lambda x=synthetic_input(n): function(x), repeat)
+            results[name + "/synthetic-" + str(n)] = {"time": t, "peak_memory": peak, "n": n}
+            synthetic_times.append(t)
+            if verbose:
+                print("%-26s %-24s %12.6f s %12.1f KiB" % (name, "synthetic-" + str(n), t, peak / 1024))
+
+        exponents[name] = scaling_exponent(sizes, synthetic_times)
+        if verbose and exponents[name] is not None:
+            print("%-26s %-24s %12.2f" % (name, "scaling exponent", exponents[name]))
+
+        for type, scene, data in loaded:
+            x = scene_input(data, type)
+            if x is None:
+                continue
+            t, peak = measure(lambda: function(x), repeat)
+            results[name + "/" + type + "-" + scene] = {"time": t, "peak_memory": peak, "n": int(data["data"].shape[1])}
+            if verbose:
+                print("%-26s %-24s %12.6f s %12.1f KiB" % (name, type + "-" + scene, t, peak / 1024))
+
+    machine = {"python": sys.version.split()[0], "numpy": np.__version__, "opencv": cv2.__version__,
+               "platform": platform.platform(), "processor": platform.processor()}
+
+    return {"machine": machine, "results": results, "exponents": exponents}
+
+
+def compare_to_baseline(report, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE,
+                        exponent_tolerance=EXPONENT_TOLERANCE):
+    """
+    Regressions of a report w.r.t. a baseline report. Only the entries present in both are compared.
+
+    Returns:
+      regressions : list of strings, one for each regression (empty if there are none)
+    """
+    regressions = []
+
+    for key, result in report["results"].items():
+        if key not in baseline["results"]:
+            continue
+        base = baseline["results"][key]
+
+        if result["time"] > base["time"] * (1 + time_tolerance) and result["time"] - base["time"] > MIN_TIME_DIFFERENCE:
+            regressions.append("%s: time %.6f s, baseline %.6f s (x%.2f)" % (key, result["time"], base["time"],
+                                                                              result["time"] / base["time"]))
+        if result["peak_memory"] > base["peak_memory"] * (1 + memory_tolerance):
+            regressions.append("%s: peak memory %d B, baseline %d B" % (key, result["peak_memory"], base["peak_memory"]))
+
+    for name, exponent in report["exponents"].items():
+        base = baseline["exponents"].get(name)
+        if exponent is not None and base is not None and exponent > base + exponent_tolerance:
+            regressions.append("%s: scaling exponent %.2f, baseline %.2f" % (name, exponent, base))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the stats and residual hot paths")
+    parser.add_argument("--only", nargs="+", default=None, choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="sizes of the synthetic inputs")
+    parser.add_argument("--scenes", nargs="*", default=None, help="scene names to run (default: all, none to skip them)")
+    parser.add_argument("--dataset", default=DATASET_DIR, help="folder containing adelH and adelFM")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every benchmark, the best one is kept")
+    parser.add_argument("--output", default=None, help="where to save the report (json)")
+    parser.add_argument("--save-baseline", default=None, help="save the report as the baseline (json)")
+    parser.add_argument("--baseline", default=None, help="baseline (json) to check the report against")
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE, help="relative time increase flagged as regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.only, args.sizes, args.scenes, args.dataset, args.repeat)
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), time_tolerance=args.tolerance)
+
+        for regression in regressions:
+            print("REGRESSION", regression)
+        print(len(regressions), "regressions against", args.baseline)
+
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,175 @@
+"""Runs the homography and fundamental matrix pipelines of FINAL_H.ipynb / FINAL_FM.ipynb over all the scenes of
+DATASET/adelH and DATASET/adelFM, one scene per worker process.
+
+Usage:
+    python dataset_runner.py --dataset ../DATASET --types H FM --workers 4 --output results.pkl
+"""
+import argparse
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import scipy.io as spi
+
+from stats import *
+from utils import *
+from Inlier_Thresholder import Inlier_Thresholder
+import instrumentation as ins
+import model_cache as mc
+
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DATASET")
+
+SUBFOLDERS = {"H": "adelH", "FM": "adelFM"}
+
+# alphas used in the notebooks
+H_ALPHAS = {"Median AD": 3.5, "Variance based": 2.5, "Rosseeuw SN": 3.5, "Rosseeuw QN": 3.5}
+FM_ALPHAS = {"Median AD": 4, "Variance based": 5, "Rosseeuw SN": 4, "Rosseeuw QN": 4}
+
+METHOD = "gc-ransac"  # estimator of the refit with the thresholds
+
+
+def list_scenes(dataset_dir=DATASET_DIR, type='H'):
+    """Sorted paths of the .mat files of the H or FM folder of the dataset."""
+    folder = os.path.join(dataset_dir, SUBFOLDERS[type])
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith('.mat')]
+
+
+def run_scene_H(data, alphas=H_ALPHAS, method=METHOD):
+    """Homography pipeline of a single scene: LMEDS residuals -> inlier thresholds (best method according to the
+    silhouette) -> refit with the thresholds -> residual, partition and soft clustering matrices."""
+    res_lmeds = build_residual_matrix(data, verbose=False)
+    curves = compute_inliers_residual_curve(data, res=res_lmeds, verbose=False)
+
+    thresholds = []
+    for curve in curves:
+        _, threshold = Inlier_Thresholder(curve, type="H", alphas=alphas).use_best_method(verbose=False)
+        thresholds.append(threshold)
+
+    residual_matrix, inliers, outliers = build_residual_matrix(data, verbose=False, method=method, threshold=thresholds,
+                                                               return_inl_out=True)
+
+    return {"thresholds": np.array(thresholds, dtype=np.float64),
+            "residual_matrix_lmeds": res_lmeds,
+            "residual_matrix": residual_matrix,
+            "partition_matrix": build_partition_matrix(residual_matrix),
+            "soft_clustering": soft_clustering_assignment(residual_matrix, thresholds),
+            "n_inliers": inliers,
+            "n_outliers": outliers}
+
+
+def run_scene_FM(data, alphas=FM_ALPHAS, method=METHOD, n_jobs=1):
+    """Fundamental matrix pipeline of a single scene: "Variance based" thresholds on the SED and on the Sampson residuals ->
+    ensemble of estimators for both -> points that are inliers for both ensembles -> residual, partition and soft
+    clustering matrices (Sampson distance). n_jobs are the threads of the ensemble fits, 1 by default since the scenes
+    already run in parallel on the process pool."""
+    thresholds = {}
+    for metric in ["sed", "sampson"]:
+        curves, n_inl, n_outl = compute_inliers_residual_curve(data, type='FM', return_inl_outl=True, verbose=False,
+                                                               metric=metric)
+        thresholds[metric] = [Inlier_Thresholder(curves[j], n_inl[j], n_outl[j], alphas=alphas)
+                              .compute_inlier_threshold("Variance based")[1] for j in range(len(curves))]
+
+    ens_sed = build_ensemble_mask(data, verbose=False, threshold=thresholds["sed"], n_jobs=n_jobs)
+    ens_sampson = build_ensemble_mask(data, verbose=False, threshold=thresholds["sampson"], n_jobs=n_jobs)
+    ensemble_labels = [np.where(a + b < 2, 0, 1) for a, b in zip(ens_sed, ens_sampson)]
+
+    residual_matrix = build_residual_matrix(data, type='FM', verbose=False, method=method,
+                                            threshold=thresholds["sampson"], metric="sampson")
+
+    return {"thresholds_sed": np.array(thresholds["sed"], dtype=np.float64),
+            "thresholds": np.array(thresholds["sampson"], dtype=np.float64),
+            "ensemble_labels": ensemble_labels,
+            "residual_matrix": residual_matrix,
+            "partition_matrix": build_partition_matrix(residual_matrix),
+            "soft_clustering": soft_clustering_assignment(residual_matrix, thresholds["sampson"])}
+
+
+PIPELINES = {"H": run_scene_H, "FM": run_scene_FM}
+
+
+def _init_worker(cv2_threads, cache_dir=None):
+    # one scene per process: OpenCV must not spawn its own threads on top of the pool
+    cv2.setNumThreads(cv2_threads)
+    # the disk tier of the model cache is shared by the workers
+    if cache_dir is not None:
+        mc.enable_cache(cache_dir)
+
+
+def _run_file(args):
+    path, type, record = args
+    data = spi.loadmat(path)
+    if not record:
+        return PIPELINES[type](data)
+
+    with ins.Recorder(scene=os.path.splitext(os.path.basename(path))[0], type=type) as recorder:
+        result = PIPELINES[type](data)
+    result["instrumentation"] = recorder.events + [recorder.summary()]
+    return result
+
+
+def run_dataset(dataset_dir=DATASET_DIR, types=("H", "FM"), workers=None, cv2_threads=1, scenes=None, record=False,
+                cache_dir=None):
+    """Runs the pipelines over all the scenes, distributing the scenes over a pool of worker processes.
+
+    Args:
+      dataset_dir : folder containing adelH and adelFM
+      types : pipelines to run, "H" and/or "FM"
+      workers : number of processes, default os.cpu_count(). With workers=1 everything runs in this process
+      cv2_threads : number of OpenCV threads of each worker
+      scenes : optional list of scene names (file names without .mat) to restrict the run
+      record : if True every scene runs under an instrumentation Recorder, its events and summary (json lines) are
+               stored in the "instrumentation" entry of the result
+      cache_dir : folder of a model_cache shared by the workers, the models already fitted by a previous run with the
+                  same points, method, threshold and seed are read from it instead of being fitted again
+
+    Returns:
+      bundle : dictionary {"H": {scene: result}, "FM": {scene: result}}, results as returned by run_scene_H / run_scene_FM
+    """
+    jobs = []
+    for type in types:
+        for path in list_scenes(dataset_dir, type):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if scenes is None or name in scenes:
+                jobs.append((type, name, path))
+
+    if workers == 1:
+        _init_worker(cv2_threads, cache_dir)
+        results = [_run_file((path, type, record)) for type, _, path in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cv2_threads, cache_dir)) as pool:
+            results = list(pool.map(_run_file, [(path, type, record) for type, _, path in jobs]))
+
+    bundle = {type: {} for type in types}
+    for (type, name, _), result in zip(jobs, results):
+        bundle[type][name] = result
+
+    return bundle
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the H and FM pipelines over the AdelaideRMF scenes")
+    parser.add_argument("--dataset", default=DATASET_DIR, help="folder containing adelH and adelFM")
+    parser.add_argument("--types", nargs="+", default=["H", "FM"], choices=["H", "FM"])
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--cv2-threads", type=int, default=1, help="OpenCV threads per worker")
+    parser.add_argument("--scenes", nargs="*", default=None, help="scene names to run (default: all)")
+    parser.add_argument("--output", default="results.pkl", help="where to save the result bundle")
+    parser.add_argument("--events", default=None, help="record the stage timings and counters of every scene (json lines)")
+    parser.add_argument("--cache", default=None, help="folder of the model cache, fitted models are reused across runs")
+    args = parser.parse_args()
+
+    bundle = run_dataset(args.dataset, args.types, args.workers, args.cv2_threads, args.scenes, record=args.events is not None,
+                         cache_dir=args.cache)
+
+    if args.events is not None:
+        for results in bundle.values():
+            for result in results.values():
+                ins.write_jsonl(result.pop("instrumentation"), args.events)
+
+    with open(args.output, "wb") as f:
+        pickle.dump(bundle, f)
+
+    print("Saved", sum(len(v) for v in bundle.values()), "scenes to", args.output)
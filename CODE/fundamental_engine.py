@@ -0,0 +1,238 @@
+"""NumPy LMedS / RANSAC fundamental matrix estimation with batched hypotheses.
+
+Minimal samples are drawn in bulk and solved all together: the 7-point algorithm (null space of the 7 x 9 systems by
+one batched SVD, the cubic det(a F1 + (1 - a) F2) = 0 solved for all the samples through the eigenvalues of the
+companion matrices) or the 8-point algorithm with rank 2 enforcement, both on Hartley normalized points. All the
+hypotheses are scored with the Sampson distance in (hypotheses x points) blocks, and the residuals of the selected
+model are returned with it, so they do not need to be recomputed.
+
+The estimator is registered in utils.FITTING_ALGS as "NP-LMEDS_FM" and "NP-RANSAC_FM", verify_FM(method="NP-LMEDS")
+uses it as well.
+"""
+import numpy as np
+
+from homography_engine import hartley_normalization, sample_minimal_sets
+
+
+N_SAMPLES = 1000  # minimal samples, the 7-point algorithm gives 1 or 3 hypotheses for each of them
+
+
+######## Batched solvers
+
+def _design_matrix(s, d):
+    # rows of the epipolar constraint d^T F s = 0 in the unknowns F.ravel()
+    x, y, u, v = s[..., 0], s[..., 1], d[..., 0], d[..., 1]
+    return np.stack([u * x, u * y, u, v * x, v * y, v, x, y, np.ones_like(x)], axis=-1)
+
+
+def _denormalize(F, T_src, T_dst):
+    F = np.swapaxes(T_dst, -1, -2) @ F @ T_src
+    # unit Frobenius norm, then F[2,2] = 1 when possible as returned by OpenCV
+    F = F / np.linalg.norm(F, axis=(-2, -1))[..., None, None]
+    scale = np.where(np.abs(F[..., 2, 2]) > 1e-12, F[..., 2, 2], 1)
+    return F / scale[..., None, None]
+
+
+def enforce_rank2(F):
+    """Closest rank 2 matrices (Frobenius norm) of a batch of 3x3 matrices, zeroing the smallest singular value."""
+    u, s, vt = np.linalg.svd(F)
+    s[..., 2] = 0
+    return u @ (s[..., :, None] * vt)
+
+
+def batch_eight_point(src, dst):
+    """
+    Normalized 8-point algorithm for a batch of point sets.
+
+    Args:
+    src: array (K, n, 2) of points in the first image, n >= 8
+    dst: array (K, n, 2) of the corresponding points in the second image
+
+    Returns:
+    F: array (K, 3, 3) of rank 2 fundamental matrices, dst^T F src = 0
+    """
+    T_src, s = hartley_normalization(np.asarray(src, dtype=np.float64))
+    T_dst, d = hartley_normalization(np.asarray(dst, dtype=np.float64))
+
+    A = _design_matrix(s, d)
+    _, _, vt = np.linalg.svd(A, full_matrices=A.shape[-2] < 9)
+    F = enforce_rank2(vt[..., -1, :].reshape(A.shape[:-2] + (3, 3)))
+
+    return _denormalize(F, T_src, T_dst)
+
+
+def batch_seven_point(src, dst):
+    """
+    Normalized 7-point algorithm for a batch of samples.
+
+    Args:
+    src: array (K, 7, 2) of points in the first image
+    dst: array (K, 7, 2) of the corresponding points in the second image
+
+    Returns:
+    F: array (M, 3, 3) of fundamental matrices (rank 2 by construction), 1 or 3 for each sample
+    sample: array (M, ) index of the sample of each matrix
+    """
+    T_src, s = hartley_normalization(np.asarray(src, dtype=np.float64))
+    T_dst, d = hartley_normalization(np.asarray(dst, dtype=np.float64))
+
+    _, _, vt = np.linalg.svd(_design_matrix(s, d), full_matrices=True)
+    F1, F2 = vt[:, -1].reshape(-1, 3, 3), vt[:, -2].reshape(-1, 3, 3)
+    D = F1 - F2
+
+    # p(a) = det(F2 + a D) is a cubic: its coefficients from the values in a = 0, 1, -1, 2
+    p0, p1, pm1, p2 = (np.linalg.det(F2 + a * D) for a in (0, 1, -1, 2))
+    c0 = p0
+    c2 = (p1 + pm1) / 2 - c0
+    odd = (p1 - pm1) / 2  # c3 + c1
+    c3 = (p2 - 4 * c2 - c0 - 2 * odd) / 6
+    c1 = odd - c3
+
+    valid = np.abs(c3) > 1e-12 * (np.abs(c0) + np.abs(c1) + np.abs(c2) + np.abs(c3))
+    c3 = np.where(valid, c3, 1)
+
+    # roots of the monic cubic = eigenvalues of its companion matrix
+    companion = np.zeros((len(c0), 3, 3))
+    companion[:, 0] = -np.stack((c2, c1, c0), axis=-1) / c3[:, None]
+    companion[:, 1, 0] = 1
+    companion[:, 2, 1] = 1
+    roots = np.linalg.eigvals(companion)
+
+    real = valid[:, None] & (np.abs(roots.imag) <= 1e-8 * (1 + np.abs(roots.real)))
+    sample, root = np.nonzero(real)
+    F = F2[sample] + roots.real[sample, root][:, None, None] * D[sample]
+
+    return _denormalize(F, T_src[sample], T_dst[sample]), sample
+
+
+######## Scoring
+
+def sampson_distances(F, src, dst):
+    """
+    Sampson distance of the points w.r.t. a batch of fundamental matrices, the same value of utils.batch_sampson_distance
+    (transposed). Undefined values (degenerate matrices) are infinite.
+
+    Args:
+    F: array (K, 3, 3)
+    src, dst: arrays (N, 2)
+
+    Returns:
+    distances: array (K, N)
+    """
+    src_hom = np.column_stack((src, np.ones(len(src))))
+    dst_hom = np.column_stack((dst, np.ones(len(dst))))
+
+    Fx1 = F @ src_hom.T  # (K, 3, N) epilines in the second image
+    Ftx2 = np.swapaxes(F, 1, 2) @ dst_hom.T  # (K, 3, N) epilines in the first image
+
+    x2tFx1 = np.sum(Fx1 * dst_hom.T, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = x2tFx1 ** 2 / (Fx1[:, 0] ** 2 + Fx1[:, 1] ** 2 + Ftx2[:, 0] ** 2 + Ftx2[:, 1] ** 2)
+
+    return np.where(np.isnan(distances), np.inf, distances)
+
+
+######## Estimator
+
+def find_fundamental(src_points, dst_points, method="LMEDS", threshold=3.0, solver="7-point", n_samples=N_SAMPLES,
+                     refine=True, seed=0, block_size=2 ** 22):
+    """
+    Robust fundamental matrix estimation with batched hypotheses.
+
+    LMEDS selects the hypothesis with the smallest median Sampson distance; the inliers are the points within the robust
+    standard deviation of OpenCV, 2.5 * 1.4826 * (1 + 5 / (N - 7)) * sqrt(median). RANSAC selects the hypothesis with
+    most points with Sampson distance below threshold^2 (ties broken by the truncated distance). With refine the model is
+    then re-estimated with the 8-point algorithm on all the inliers; as in OpenCV the mask is the one of the selected
+    hypothesis.
+
+    Args:
+    src_points: array (N, 2) of points in the first image (also (N, 1, 2), as passed to cv2.findFundamentalMat)
+    dst_points: array (N, 2) of the corresponding points in the second image
+    method: "LMEDS" or "RANSAC"
+    threshold: distance threshold of RANSAC in pixels, compared with the square root of the Sampson distance (ignored by
+               LMEDS, default 3 as in OpenCV when None)
+    solver: "7-point" (default, as OpenCV) or "8-point" minimal solver
+    n_samples: number of minimal samples
+    refine: re-estimate the model on the inliers
+    seed: seed of the sampling, fixed by default so that results are reproducible as with OpenCV
+    block_size: maximum number of entries of the (hypotheses x points) blocks of distances, bounds the memory
+
+    Returns:
+    F: fundamental matrix, (3x3 numpy matrix)
+    mask: labels for inlier and outliers    1-inlier ;  0-outlier (uint8 numpy array of shape (N, ))
+    residuals: Sampson distance of every point w.r.t. F, (N, ) as returned by utils.compute_sampson_distance
+    median: median Sampson distance of the selected hypothesis (the LMedS score)
+
+    Raises:
+    ValueError: if the samples give no hypothesis (degenerate configurations, e.g. coincident points)
+    """
+    method = method.upper()
+    assert method in ("LMEDS", "RANSAC")
+    assert solver in ("7-point", "8-point")
+    threshold = 3.0 if threshold is None else threshold
+
+    src = np.asarray(src_points, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst_points, dtype=np.float64).reshape(-1, 2)
+    n = len(src)
+    sample_size = 7 if solver == "7-point" else 8
+
+    samples = sample_minimal_sets(n, n_samples, sample_size, rng=seed)
+    if solver == "7-point":
+        hypotheses, _ = batch_seven_point(src[samples], dst[samples])
+        if len(hypotheses) == 0 and n >= 8:
+            # no sample with a real root (degenerate configurations): 8-point samples instead
+            samples = sample_minimal_sets(n, n_samples, 8, rng=seed)
+            hypotheses = batch_eight_point(src[samples], dst[samples])
+    else:
+        hypotheses = batch_eight_point(src[samples], dst[samples])
+
+    hypotheses = hypotheses[np.all(np.isfinite(hypotheses), axis=(1, 2))]
+    if len(hypotheses) == 0:
+        raise ValueError("No fundamental matrix hypothesis from the %d points (degenerate configuration)" % n)
+
+    # score the hypotheses by blocks, keeping the best one
+    best, best_score, best_distances = None, None, None
+    step = max(1, block_size // n)
+    for start in range(0, len(hypotheses), step):
+        distances = sampson_distances(hypotheses[start:start + step], src, dst)
+
+        if method == "LMEDS":
+            scores = np.median(distances, axis=1)
+            k = int(np.argmin(scores))
+            score = scores[k]
+        else:
+            inliers = np.sum(distances <= threshold ** 2, axis=1)
+            cost = np.sum(np.minimum(distances, threshold ** 2), axis=1)
+            k = np.lexsort((cost, -inliers))[0]
+            score = (-inliers[k], cost[k])
+
+        if best_score is None or score < best_score:
+            best, best_score, best_distances = start + k, score, distances[k]
+
+    median = float(np.median(best_distances))
+
+    if method == "LMEDS":
+        sigma = 2.5 * 1.4826 * (1 + 5 / (n - 7)) * np.sqrt(median) if n > 7 else 0
+        mask = (best_distances <= sigma ** 2).astype(np.uint8)
+    else:
+        mask = (best_distances <= threshold ** 2).astype(np.uint8)
+
+    F = hypotheses[best]
+    if refine and mask.sum() >= 8:
+        refined = batch_eight_point(src[mask == 1][None], dst[mask == 1][None])[0]
+        if np.all(np.isfinite(refined)):
+            F = refined
+
+    residuals = sampson_distances(F[None], src, dst)[0]
+
+    return F, mask, residuals, median
+
+
+def lmeds_fundamental(src_points, dst_points, threshold=None, **kwargs):
+    """find_fundamental with LMEDS, registered as "NP-LMEDS_FM"."""
+    return find_fundamental(src_points, dst_points, "LMEDS", threshold, **kwargs)
+
+
+def ransac_fundamental(src_points, dst_points, threshold=None, **kwargs):
+    """find_fundamental with RANSAC, registered as "NP-RANSAC_FM"."""
+    return find_fundamental(src_points, dst_points, "RANSAC", threshold, **kwargs)
@@ -0,0 +1,209 @@
+"""NumPy LMedS / RANSAC homography estimation with batched hypotheses.
+
+Thousands of minimal samples are drawn at once, the 4-point DLT of all of them is solved with a single batched SVD
+(Hartley normalization of every sample) and every hypothesis is scored against all the points in one
+(hypotheses x points) block of reprojection errors. Unlike cv2.findHomography the residuals of the selected model are
+returned, together with the LMedS median.
+
+The estimator is registered in utils.FITTING_ALGS as "NP-LMEDS" and "NP-RANSAC", so it can be used through
+verify_H(method=...) and build_residual_matrix(method=...).
+"""
+import numpy as np
+
+
+SAMPLE_SIZE = 4  # points of the minimal sample of a homography
+N_HYPOTHESES = 2000
+
+
+######## Normalized DLT of many point sets at once
+
+def hartley_normalization(points):
+    """
+    Hartley normalization of a batch of point sets: each set is translated to have the centroid in the origin and
+    scaled to have mean distance sqrt(2) from it.
+
+    Args:
+    points: array (..., n, 2) of point sets
+
+    Returns:
+    T: array (..., 3, 3) of the normalizing similarities
+    normalized: array (..., n, 2) of the normalized points
+    """
+    centroid = points.mean(axis=-2, keepdims=True)
+    mean_distance = np.mean(np.linalg.norm(points - centroid, axis=-1), axis=-1)
+    scale = np.sqrt(2) / np.where(mean_distance > 0, mean_distance, 1)
+
+    T = np.zeros(points.shape[:-2] + (3, 3))
+    T[..., 0, 0] = scale
+    T[..., 1, 1] = scale
+    T[..., :2, 2] = -scale[..., None] * centroid[..., 0, :]
+    T[..., 2, 2] = 1
+
+    return T, (points - centroid) * scale[..., None, None]
+
+
+def _dlt_system(s, d):
+    # (..., 2n, 9) DLT system of the correspondences s -> d, two rows for each point in the unknowns H.ravel()
+    x, y, u, v = s[..., 0], s[..., 1], d[..., 0], d[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+
+    A = np.empty(x.shape[:-1] + (2 * x.shape[-1], 9))
+    A[..., 0::2, :] = np.stack([-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u], axis=-1)
+    A[..., 1::2, :] = np.stack([zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v], axis=-1)
+    return A
+
+
+def batch_dlt(src, dst):
+    """
+    Homographies mapping src to dst for a batch of point sets, normalized DLT: the null vector of every (2n, 9) DLT
+    system from one batched SVD.
+
+    Args:
+    src: array (K, n, 2) of source points, n >= 4
+    dst: array (K, n, 2) of destination points
+
+    Returns:
+    H: array (K, 3, 3) of homographies, scaled to H[2,2] = 1 (unit norm when H[2,2] is 0)
+    """
+    T_src, s = hartley_normalization(np.asarray(src, dtype=np.float64))
+    T_dst, d = hartley_normalization(np.asarray(dst, dtype=np.float64))
+
+    A = _dlt_system(s, d)
+
+    # with 4 points the system is 8 x 9: the full V is needed to get the null vector
+    _, _, vt = np.linalg.svd(A, full_matrices=A.shape[-2] < 9)
+    H = np.linalg.inv(T_dst) @ vt[..., -1, :].reshape(s.shape[:-2] + (3, 3)) @ T_src
+
+    scale = H[..., 2, 2]
+    degenerate = np.abs(scale) < 1e-12
+    scale = np.where(degenerate, np.linalg.norm(H, axis=(-2, -1)), scale)
+
+    return H / scale[..., None, None]
+
+
+######## Sampling and scoring
+
+def sample_minimal_sets(n_points, n_samples, sample_size=SAMPLE_SIZE, rng=None):
+    """(n_samples, sample_size) indices of random samples of distinct points."""
+    if n_points < sample_size:
+        raise ValueError("At least %d points are needed, got %d" % (sample_size, n_points))
+    rng = np.random.default_rng(rng)
+
+    samples = rng.integers(0, n_points, (n_samples, sample_size))
+    while True:
+        sorted_samples = np.sort(samples, axis=1)
+        repeated = np.any(sorted_samples[:, 1:] == sorted_samples[:, :-1], axis=1)
+        if not repeated.any():
+            return samples
+        samples[repeated] = rng.integers(0, n_points, (repeated.sum(), sample_size))
+
+
+def reprojection_errors(H, src, dst):
+    """
+    Squared reprojection errors of the points under a batch of homographies, ||H src - dst||^2 (the square of
+    utils.compute_residual). Points mapped to infinity get an infinite error.
+
+    Args:
+    H: array (K, 3, 3)
+    src, dst: arrays (N, 2)
+
+    Returns:
+    errors: array (K, N)
+    """
+    projected = H[:, :, :2] @ src.T + H[:, :, 2:]  # (K, 3, N), batched matmul
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = 1 / projected[:, 2]
+        errors = (projected[:, 0] * w - dst[:, 0]) ** 2 + (projected[:, 1] * w - dst[:, 1]) ** 2
+
+    return np.where(np.isnan(errors), np.inf, errors)
+
+
+######## Estimator
+
+def find_homography(src_points, dst_points, method="LMEDS", threshold=3.0, n_hypotheses=N_HYPOTHESES, refine=True, seed=0,
+                    block_size=2 ** 22):
+    """
+    Robust homography estimation with batched hypotheses.
+
+    LMEDS selects the hypothesis with the smallest median of the squared reprojection errors; the inliers are the points
+    within the robust standard deviation of OpenCV, 2.5 * 1.4826 * (1 + 5 / (N - 4)) * sqrt(median). RANSAC selects the
+    hypothesis with most points with squared error below threshold^2 (ties broken by the truncated squared error).
+    With refine the model is then re-estimated by normalized DLT on all the inliers; as in OpenCV the mask is the one of
+    the selected hypothesis.
+
+    Args:
+    src_points: array (N, 2) of source points (also (N, 1, 2), as passed to cv2.findHomography)
+    dst_points: array (N, 2) of destination points
+    method: "LMEDS" or "RANSAC"
+    threshold: reprojection error threshold of RANSAC (ignored by LMEDS, default 3 as in OpenCV when None)
+    n_hypotheses: number of minimal samples
+    refine: re-estimate the model on the inliers
+    seed: seed of the sampling, fixed by default so that results are reproducible as with OpenCV
+    block_size: maximum number of entries of the (hypotheses x points) blocks of errors, bounds the memory
+
+    Returns:
+    H: homography, (3x3 numpy matrix)
+    mask: labels for inlier and outliers    1-inlier ;  0-outlier (uint8 numpy array of shape (N, ))
+    residuals: reprojection error of every point under H, (N, ) as returned by utils.compute_residual
+    median: median of the squared reprojection errors of the selected hypothesis (the LMedS score)
+    """
+    method = method.upper()
+    assert method in ("LMEDS", "RANSAC")
+    threshold = 3.0 if threshold is None else threshold
+
+    src = np.asarray(src_points, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst_points, dtype=np.float64).reshape(-1, 2)
+    n = len(src)
+
+    samples = sample_minimal_sets(n, n_hypotheses, rng=seed)
+    hypotheses = batch_dlt(src[samples], dst[samples])
+
+    # score the hypotheses by blocks, keeping the best one
+    best, best_score = None, None
+    step = max(1, block_size // n)
+    for start in range(0, n_hypotheses, step):
+        errors = reprojection_errors(hypotheses[start:start + step], src, dst)
+
+        if method == "LMEDS":
+            scores = np.median(errors, axis=1)
+            k = int(np.argmin(scores))
+            score = scores[k]
+            better = best_score is None or score < best_score
+        else:
+            inliers = np.sum(errors <= threshold ** 2, axis=1)
+            cost = np.sum(np.minimum(errors, threshold ** 2), axis=1)
+            k = np.lexsort((cost, -inliers))[0]
+            score = (-inliers[k], cost[k])
+            better = best_score is None or score < best_score
+
+        if better:
+            best, best_score, best_errors = start + k, score, errors[k]
+
+    median = float(np.median(best_errors))
+
+    if method == "LMEDS":
+        sigma = 2.5 * 1.4826 * (1 + 5 / (n - SAMPLE_SIZE)) * np.sqrt(median) if n > SAMPLE_SIZE else 0
+        mask = (best_errors <= sigma ** 2).astype(np.uint8)
+    else:
+        mask = (best_errors <= threshold ** 2).astype(np.uint8)
+
+    H = hypotheses[best]
+    if refine and mask.sum() > SAMPLE_SIZE:
+        refined = batch_dlt(src[mask == 1][None], dst[mask == 1][None])[0]
+        if np.all(np.isfinite(refined)):
+            H = refined
+
+    residuals = np.sqrt(reprojection_errors(H[None], src, dst)[0])
+
+    return H, mask, residuals, median
+
+
+def lmeds_homography(src_points, dst_points, threshold=None, **kwargs):
+    """find_homography with LMEDS, registered as "NP-LMEDS"."""
+    return find_homography(src_points, dst_points, "LMEDS", threshold, **kwargs)
+
+
+def ransac_homography(src_points, dst_points, threshold=None, **kwargs):
+    """find_homography with RANSAC, registered as "NP-RANSAC"."""
+    return find_homography(src_points, dst_points, "RANSAC", threshold, **kwargs)
@@ -0,0 +1,184 @@
+"""Influence of every point on the fitted homography / fundamental matrix, without refits.
+
+The DLT (homography) and the 8-point algorithm (fundamental matrix) take the model as the eigenvector of the smallest
+eigenvalue of the normal matrix S = A^T A of the Hartley normalized system. Every point contributes the outer product
+of its own rows of A (two rows for the DLT, one for the 8-point), so the normal matrix of the leave-one-out fit is a
+rank two / rank one downdate of S:
+
+    S_-i = S - A_i^T A_i
+
+and all the leave-one-out models come from a single batched eigendecomposition of the N downdated 9 x 9 matrices,
+instead of N refits. A refit normalizes the points without i with its own centroid and scale: the downdate is mapped
+into that normalization, R_i = T_i T^-1 in each image being a similarity, by the 9 x 9 change of coordinates of the
+rows (a row of the 8-point system is kron(d, s), a pair of DLT rows transforms as kron(R_dst^-T, R_src) up to a scale),
+
+    S'_i = K_i S_-i K_i^T,    K_i = R_dst,i (x) R_src,i  (8-point),    R_dst,i^-T (x) R_src,i  (DLT)
+
+so the leave-one-out models are those of the normalized DLT / 8-point refits.
+
+    influence = scene_influence(data, type='H')       # one score per row of build_residual_matrix(data)
+"""
+import numpy as np
+
+import homography_engine as he
+import fundamental_engine as fe
+import visual as vi
+from utils import extract_points
+
+
+MIN_POINTS = {'H': 5, 'FM': 9}  # the leave-one-out fits need 4 (DLT) / 8 (8-point) points
+
+
+######## Leave-one-out models
+
+def _normal_equations(src, dst, type):
+    # (N, r, 9) rows of every point in the normalized system, with T_src, T_dst
+    T_src, s = he.hartley_normalization(src)
+    T_dst, d = he.hartley_normalization(dst)
+    if type == 'H':
+        rows = he._dlt_system(s, d).reshape(len(s), 2, 9)
+    else:
+        rows = fe._design_matrix(s, d)[:, None, :]
+    return rows, T_src, T_dst
+
+
+def _leave_one_out_normalization(points, block_size=2 ** 22):
+    # (N, 3, 3) Hartley normalization of the points without the point i, as he.hartley_normalization of the subset: the
+    # centroid is a downdate, the mean distance from it needs all the points (block_size distances at a time)
+    n = len(points)
+    centroids = (points.sum(axis=0) - points) / (n - 1)
+    mean_distance = np.empty(n)
+    step = max(1, block_size // n)
+    for start in range(0, n, step):
+        block = centroids[start:start + step]
+        distances = np.linalg.norm(points[None, :, :] - block[:, None, :], axis=-1)
+        distances[np.arange(len(block)), np.arange(start, start + len(block))] = 0
+        mean_distance[start:start + step] = distances.sum(axis=1) / (n - 1)
+    scale = np.sqrt(2) / np.where(mean_distance > 0, mean_distance, 1)
+
+    T = np.zeros((n, 3, 3))
+    T[:, 0, 0] = scale
+    T[:, 1, 1] = scale
+    T[:, :2, 2] = -scale[:, None] * centroids
+    T[:, 2, 2] = 1
+    return T
+
+
+def _denormalize_H(H, T_src, T_dst):
+    H = np.linalg.inv(T_dst) @ H @ T_src
+    scale = H[..., 2, 2]
+    scale = np.where(np.abs(scale) < 1e-12, np.linalg.norm(H, axis=(-2, -1)), scale)
+    return H / scale[..., None, None]
+
+
+def leave_one_out_models(src_points, dst_points, type='H'):
+    """
+    Model fitted on all the points and the N models fitted leaving out one point at a time.
+
+    Args:
+      src_points : array (N, 2) of points in the first image
+      dst_points : array (N, 2) of the corresponding points in the second image
+      type : 'H' for the normalized DLT, 'FM' for the normalized 8-point algorithm (rank 2 enforced)
+
+    Returns:
+      M : model of all the points, (3x3 numpy matrix) scaled to M[2,2] = 1
+      M_loo : array (N, 3, 3), M_loo[i] is the model without the point i
+    """
+    assert type in ('H', 'FM'), "Types: 'H' or 'FM'"
+    src = np.asarray(src_points, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst_points, dtype=np.float64).reshape(-1, 2)
+    if len(src) < MIN_POINTS[type]:
+        raise ValueError("At least %d points are needed, got %d" % (MIN_POINTS[type], len(src)))
+
+    rows, T_src, T_dst = _normal_equations(src, dst, type)
+    contributions = np.swapaxes(rows, 1, 2) @ rows  # (N, 9, 9) A_i^T A_i
+    S = contributions.sum(axis=0)
+
+    # downdates mapped into the normalization of each leave-one-out subset
+    T_src_loo, T_dst_loo = _leave_one_out_normalization(src), _leave_one_out_normalization(dst)
+    R_src, R_dst = T_src_loo @ np.linalg.inv(T_src), T_dst_loo @ np.linalg.inv(T_dst)
+    if type == 'H':
+        R_dst = np.swapaxes(np.linalg.inv(R_dst), 1, 2)
+    K = np.einsum("nab,ncd->nacbd", R_dst, R_src).reshape(-1, 9, 9)
+    downdates = K @ (S[None] - contributions) @ np.swapaxes(K, 1, 2)
+
+    # full model and the downdates in one batched eigendecomposition, eigenvalues in ascending order
+    _, vectors = np.linalg.eigh(np.concatenate((S[None], downdates)))
+    models = vectors[:, :, 0].reshape(-1, 3, 3)
+
+    T_src = np.concatenate((T_src[None], T_src_loo))
+    T_dst = np.concatenate((T_dst[None], T_dst_loo))
+    if type == 'H':
+        models = _denormalize_H(models, T_src, T_dst)
+    else:
+        models = fe._denormalize(fe.enforce_rank2(models), T_src, T_dst)
+
+    return models[0], models[1:]
+
+
+######## Influence scores
+
+def _residuals(M, src, dst, type):
+    # (K, N) residuals of the points w.r.t. K models, as compute_residual / compute_sampson_distance
+    if type == 'H':
+        return np.sqrt(he.reprojection_errors(M, src, dst))
+    return fe.sampson_distances(M, src, dst)
+
+
+def influence_scores(src_points, dst_points, type='H', block_size=2 ** 22):
+    """
+    Influence of every point on the model fitted on all the points.
+
+    Args:
+      src_points, dst_points : arrays (N, 2) of corresponding points
+      type : 'H' or 'FM'
+      block_size : maximum number of entries of the (models x points) blocks of residuals, bounds the memory
+
+    Returns:
+      scores : dictionary of arrays (N, )
+               - "parameter" : ||M_loo[i] - M|| / ||M|| (Frobenius norms, matrices scaled to M[2,2] = 1)
+               - "residual" : root mean square change of the residuals of all the points when i is left out
+    """
+    src = np.asarray(src_points, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst_points, dtype=np.float64).reshape(-1, 2)
+    M, M_loo = leave_one_out_models(src, dst, type)
+
+    parameter = np.linalg.norm(M_loo - M, axis=(1, 2)) / np.linalg.norm(M)
+
+    full = _residuals(M[None], src, dst, type)[0]
+    residual = np.empty(len(src))
+    step = max(1, block_size // len(src))
+    for start in range(0, len(src), step):
+        change = _residuals(M_loo[start:start + step], src, dst, type) - full
+        residual[start:start + step] = np.sqrt(np.mean(change ** 2, axis=1))
+
+    return {"parameter": parameter, "residual": residual}
+
+
+def scene_influence(data, type='H', masks=None, score="residual"):
+    """
+    Influence of every point of the scene on the model of its label.
+
+    Args:
+      data : single data file from the folder of files
+      type : 'H' or 'FM'
+      masks : optional list with a 0/1 mask of the points of each model (as returned by build_ensemble_mask): the model
+              is fitted only on the points with mask 1, the others get nan. A model left with less than MIN_POINTS
+              points gets nan for all its points
+      score : "residual" or "parameter", see influence_scores
+
+    Returns:
+      influence : numpy array (N, ), one score for each row of build_residual_matrix(data)
+    """
+    models = vi.group_models(data)["models"]
+    points = extract_points(models, data)[0]
+
+    influence = np.full(int(np.sum(data["label"] != 0)), np.nan)
+    for i in range(len(models)):
+        used = np.ones(len(points["indices"][i]), dtype=bool) if masks is None else np.ravel(masks[i]) != 0
+        if np.sum(used) < MIN_POINTS[type]:
+            continue
+        scores = influence_scores(points["src_points"][i][used], points["dst_points"][i][used], type)
+        influence[points["indices"][i][used]] = scores[score]
+
+    return influence
@@ -0,0 +1,123 @@
+"""Opt-in instrumentation of the pipelines: timers of the stages, counters and structured events.
+
+Nothing is collected unless a Recorder is active, typically one per scene:
+
+    with ins.Recorder(scene="unihouse", type="H") as recorder:
+        residual_matrix = build_residual_matrix(data)
+
+    recorder.summary()                   # calls and time of each stage, counters
+    recorder.to_jsonl("events.jsonl")    # one json object per event, plus the summary
+
+The instrumented code calls stage(), count() and event(). Without an active recorder they only check a global, so
+the instrumentation can stay in the hot paths.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+_active = None  # active recorder, shared by all the threads (the estimators of build_ensemble_mask run on a thread pool)
+
+
+class Recorder:
+
+    def __init__(self, **context):
+        """
+        Args:
+          context : fields added to every event and to the summary, e.g. scene="unihouse", type="H"
+        """
+        self.context = context
+        self.events = []
+        self.timings = {}  # stage -> [calls, total time in seconds]
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        _active = self._previous
+
+    def record(self, kind, name, fields):
+        with self._lock:
+            self.events.append({"event": kind, "name": name, **self.context, **fields})
+
+    def add_time(self, stage, seconds, fields):
+        with self._lock:
+            timing = self.timings.setdefault(stage, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+        self.record("stage", stage, {"seconds": seconds, **fields})
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Aggregated stages {stage: {"calls", "seconds"}} and counters of the recorder."""
+        with self._lock:
+            stages = {stage: {"calls": calls, "seconds": seconds} for stage, (calls, seconds) in self.timings.items()}
+            return {"event": "summary", **self.context, "stages": stages, "counters": dict(self.counters)}
+
+    def to_jsonl(self, file, summary=True):
+        """Append the events (and the summary) as json lines to a path or to an open text file."""
+        lines = self.events + ([self.summary()] if summary else [])
+        write_jsonl(lines, file)
+
+
+def _to_builtin(value):
+    # numpy values in the fields of the events
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+def write_jsonl(lines, file):
+    """Append dictionaries as json lines to a path or to an open text file."""
+    if isinstance(file, str):
+        with open(file, "a") as f:
+            return write_jsonl(lines, f)
+    for line in lines:
+        file.write(json.dumps(line, default=_to_builtin) + "\n")
+
+
+######## Instrumentation points
+
+@contextmanager
+def stage(name, **fields):
+    """Context manager timing a stage of the pipeline."""
+    recorder = _active
+    if recorder is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_time(name, time.perf_counter() - start, fields)
+
+
+def count(name, value=1):
+    """Increment a counter."""
+    recorder = _active
+    if recorder is not None:
+        recorder.add_count(name, value)
+
+
+def event(name, verbose=False, message=(), **fields):
+    """Record a structured event. With verbose, message (tuple of objects) is also printed as the former prints."""
+    if verbose:
+        print(*message)
+    recorder = _active
+    if recorder is not None:
+        recorder.record("event", name, fields)
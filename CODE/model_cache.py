@@ -0,0 +1,211 @@
+"""Content-addressed cache of the fitted models.
+
+verify_H and verify_FM (hence build_residual_matrix, build_ensemble_mask and everything built on them) look up the
+active cache before fitting: the key is the hash of the points given to the estimator, of the estimator, method,
+threshold and seed, so a re-run that only changes plotting or thresholding options finds the models already fitted.
+An entry stores the fitted matrix, the inlier mask and, when the estimator returns them, the residuals of the points,
+as .npy files in a directory named by the key. The cache has two tiers: an in-process LRU dictionary and the disk
+folder, whose size is bounded by evicting the least recently used entries.
+
+The cache is off by default, it is enabled with:
+
+    model_cache.enable_cache("~/.cache/iacv_models")       # memory + disk
+    model_cache.enable_cache()                             # memory only
+
+Note that OpenCV estimators without seed may give a different model at every call, with the cache the first one is
+returned for the same inputs.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+CACHE_VERSION = 1  # part of every key: increase it when the estimators change, to invalidate the old entries
+
+_active = None
+
+
+def cache_key(*parts):
+    """Hex sha256 of the parts: numpy arrays (dtype, shape and content), strings, numbers, None and tuples of them."""
+    digest = hashlib.sha256(("model_cache-%d" % CACHE_VERSION).encode())
+
+    def update(part):
+        if isinstance(part, np.ndarray):
+            array = np.ascontiguousarray(part)
+            digest.update(("array %s %s:" % (array.dtype.str, array.shape)).encode())
+            digest.update(memoryview(array).cast("B"))
+        elif isinstance(part, (tuple, list)):
+            digest.update(b"(")
+            for p in part:
+                update(p)
+            digest.update(b")")
+        else:
+            if isinstance(part, np.generic):
+                part = part.item()
+            digest.update(("%s %r" % (type(part).__name__, part)).encode())
+        digest.update(b"|")
+
+    for part in parts:
+        update(part)
+
+    return digest.hexdigest()
+
+
+class ModelCache:
+
+    def __init__(self, directory=None, max_bytes=2 ** 30, memory_items=512):
+        """
+        Args:
+          directory : folder of the disk tier, None for a memory only cache
+          max_bytes : maximum size of the disk tier, the least recently used entries are evicted beyond it
+          memory_items : number of entries of the in-process tier
+        """
+        self.directory = None if directory is None else os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None  # computed at the first write
+        self.hits = 0
+        self.misses = 0
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    ########### memory tier
+
+    def _remember(self, key, arrays):
+        with self._lock:
+            self._memory[key] = arrays
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    ########### disk tier
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            arrays = {f[:-4]: np.load(os.path.join(path, f)) for f in os.listdir(path) if f.endswith(".npy")}
+            os.utime(path)  # the modification time of the entry is its last use
+        except (FileNotFoundError, NotADirectoryError, ValueError, OSError):
+            return None
+        return arrays
+
+    def _store(self, key, arrays):
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+
+        # written in a temporary folder and renamed, so other processes never see half written entries
+        tmp = os.path.join(self.directory, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        size = 0
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+            size += os.path.getsize(os.path.join(tmp, name + ".npy"))
+        try:
+            os.rename(tmp, path)
+        except OSError:  # written in the meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self.disk_usage()
+            else:
+                self._disk_bytes += size
+            evict = self._disk_bytes > self.max_bytes
+        if evict:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.startswith(".tmp-") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:  # evicted by another process
+                continue
+        return entries
+
+    def disk_usage(self):
+        """Bytes used by the disk tier."""
+        return 0 if self.directory is None else sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Remove the least recently used entries of the disk tier until it fits in max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    ########### interface
+
+    def get(self, key):
+        """Dictionary of arrays stored under key (copies, the caller can modify them) or None."""
+        with self._lock:
+            arrays = self._memory.get(key)
+            if arrays is not None:
+                self._memory.move_to_end(key)
+
+        if arrays is None and self.directory is not None:
+            arrays = self._load(key)
+            if arrays is not None:
+                self._remember(key, arrays)
+
+        with self._lock:
+            if arrays is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {name: array.copy() for name, array in arrays.items()}
+
+    def put(self, key, **arrays):
+        """Store the arrays under key. Values that are None are not stored."""
+        arrays = {name: np.array(array) for name, array in arrays.items() if array is not None}
+        self._remember(key, arrays)
+        if self.directory is not None:
+            self._store(key, arrays)
+
+    def clear(self):
+        """Empty both tiers."""
+        with self._lock:
+            self._memory.clear()
+            self._disk_bytes = 0
+        if self.directory is not None:
+            for _, _, path in self._entries():
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def enable_cache(directory=None, max_bytes=2 ** 30, memory_items=512):
+    """Activate a cache for all the following fits of this process, returns it."""
+    global _active
+    _active = ModelCache(directory, max_bytes, memory_items)
+    return _active
+
+
+def disable_cache():
+    global _active
+    _active = None
+
+
+def active_cache():
+    return _active
@@ -0,0 +1,180 @@
+"""Bootstrap and jackknife confidence intervals of the inlier thresholds.
+
+The replicates of a residual vector are drawn as one (replicates x size) index matrix, and the thresholds of all the
+replicates are computed together by stats.batch_inlier_thresholds, each replicate being a segment of one flat array.
+Qn is instead computed from the number of copies of each point in the replicates: the pairwise differences of the
+original points are sorted once and weighted for every replicate, no selection among the pairs of each replicate.
+Besides the confidence interval of every method, the outlier frequency of each point is the fraction of replicates
+whose threshold labels it an outlier (residual >= threshold, as the thresholding functions of stats.py).
+
+    intervals = resample_thresholds(residuals, "bootstrap", n_replicates=2000)
+    intervals["Rosseeuw QN"]["low"], intervals["Rosseeuw QN"]["high"]
+"""
+import numpy as np
+from scipy import stats as st
+
+from stats import batch_inlier_thresholds, _d, _lerp
+
+
+METHODS = ("Median AD", "Variance based", "IQR", "Rosseeuw SN", "Rosseeuw QN")
+
+
+def bootstrap_indices(n, n_replicates=1000, rng=None):
+    """(n_replicates, n) indices of bootstrap samples, drawn with replacement."""
+    return np.random.default_rng(rng).integers(0, n, (n_replicates, n))
+
+
+def jackknife_indices(n):
+    """(n, n-1) indices of the leave-one-out samples, row i without the point i."""
+    columns = np.arange(n - 1)
+    return columns[None, :] + (columns[None, :] >= np.arange(n)[:, None])
+
+
+def _replicate_counts(n, indices):
+    # (R, n) number of copies of each point in each replicate
+    rows = np.repeat(np.arange(len(indices)), indices.shape[1])
+    return np.bincount(rows * n + indices.ravel(), minlength=len(indices) * n).reshape(len(indices), n)
+
+
+def _qn_first_quartiles(values, counts, block_size):
+    # np.percentile(|x_i - x_j|, 25) over the pairs of every replicate, without selecting among the pairs of each one: a
+    # replicate with counts[r, a] copies of point a has the differences of the pairs (a, b) of the original points, each
+    # counts[r, a] * counts[r, b] times, plus the zero differences between copies of the same point. The original
+    # differences are sorted once, the k-th of a replicate is found in the cumulative sum of its weights, accumulated
+    # by chunks of pairs until all the replicates reach k (the first quartile is found in the first chunks).
+    n = len(values)
+    size = int(counts[0].sum())
+    m = size * (size - 1) // 2
+    if m == 0:
+        return np.full(len(counts), np.nan)
+
+    a, b = np.triu_indices(n, k=1)
+    differences = np.abs(values[a] - values[b])
+    order = np.argsort(differences, kind="stable")
+    a, b, differences = a[order], b[order], differences[order]
+    counts = counts.astype(np.int32 if n < 40000 else np.int64)  # products and sums of the weights below 2^31
+    zeros = np.sum(counts * (counts - 1) // 2, axis=1)
+
+    virtual_index = 0.25 * (m - 1)
+    low = int(np.floor(virtual_index))
+    gamma = virtual_index - low
+    targets = (low + 1, min(low + 2, m))  # 1-based ranks of the two order statistics
+
+    chunk = max(1024, len(differences) // 16)
+    step = max(1, block_size // min(chunk, len(differences)))
+    quartiles = np.empty(len(counts))
+    for start in range(0, len(counts), step):
+        block = counts[start:start + step]
+        total = zeros[start:start + step].copy()
+        positions = np.full((2, len(block)), -1)
+
+        for first in range(0, len(differences), chunk):
+            cumulative = np.cumsum(block[:, a[first:first + chunk]] * block[:, b[first:first + chunk]], axis=1)
+            cumulative += total[:, None]
+            for t, target in enumerate(targets):
+                reached = (positions[t] < 0) & (cumulative[:, -1] >= target)
+                positions[t, reached] = first + np.sum(cumulative[reached] < target, axis=1)
+            total = cumulative[:, -1]
+            if np.all(positions >= 0):
+                break
+
+        kth = [np.where(target <= zeros[start:start + step], 0, differences[positions[t]])
+               for t, target in enumerate(targets)]
+        quartiles[start:start + step] = _lerp(kth[0], kth[1], gamma)
+    return quartiles
+
+
+def _replicate_thresholds(values, indices, alphas, methods, block_size):
+    # thresholds of the replicates values[indices[r]], block_size values at a time. Qn is computed from the counts of
+    # the points in the replicates (_qn_first_quartiles), the others by batch_inlier_thresholds
+    size = indices.shape[1]
+    step = max(1, block_size // max(size, 1))
+    thresholds = {method: np.empty(len(indices)) for method in methods}
+    batched = [method for method in methods if method != "Rosseeuw QN"]
+    medians = np.empty(len(indices))
+    for start in range(0, len(indices), step):
+        block = values[indices[start:start + step]]
+        medians[start:start + len(block)] = np.median(block, axis=1) if size else np.nan
+        if batched:
+            offsets = np.arange(len(block) + 1, dtype=np.int64) * size
+            block_thresholds, _ = batch_inlier_thresholds(block.ravel(), offsets, alphas, batched, return_labels=False)
+            for method in batched:
+                thresholds[method][start:start + len(block)] = block_thresholds[method]
+
+    if "Rosseeuw QN" in methods:
+        std_est = _d(size) * 2.2219 * _qn_first_quartiles(values, _replicate_counts(len(values), indices), block_size)
+        thresholds["Rosseeuw QN"] = medians + alphas["Rosseeuw QN"] * std_est
+    return thresholds
+
+
+def resample_thresholds(values, kind="bootstrap", n_replicates=1000, confidence=0.95,
+                        alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 },
+                        methods=METHODS, seed=None, block_size=2 ** 21):
+    """
+    Confidence intervals of the thresholds of a residual vector.
+
+    Args:
+      values : 1D array of residuals
+      kind : "bootstrap" (percentile intervals of n_replicates resamples) or "jackknife" (the n leave-one-out samples,
+             normal intervals with the jackknife standard error)
+      n_replicates : number of bootstrap replicates (ignored by the jackknife)
+      confidence : confidence level of the intervals
+      alphas : alpha of each method, same dictionary used by Inlier_Thresholder
+      methods : methods of stats.batch_inlier_thresholds
+      seed : seed of the bootstrap
+      block_size : maximum number of resampled values processed at once, bounds the memory
+
+    Returns:
+      intervals : dictionary method -> dictionary
+                  - "threshold" : threshold of the original values
+                  - "low", "high" : confidence interval
+                  - "std" : standard error (standard deviation of the bootstrap replicates, jackknife standard error)
+                  - "replicates" : (R, ) thresholds of the replicates
+                  - "outlier_frequency" : (n, ) fraction of the replicates labelling each point an outlier
+    """
+    assert kind in ("bootstrap", "jackknife"), "kind must be 'bootstrap' or 'jackknife'"
+    values = np.asarray(values, dtype=np.float64).ravel()
+    n = len(values)
+
+    estimates, _ = batch_inlier_thresholds(values, np.array([0, n]), alphas, methods, return_labels=False)
+    if n < 2:
+        # no spread to resample (e.g. a model without inliers): nan intervals, as the bootstrap of such vectors gives
+        n_out = n_replicates if kind == "bootstrap" else n
+        return {method: {"threshold": estimates[method][0], "low": np.nan, "high": np.nan, "std": np.nan,
+                         "replicates": np.full(n_out, np.nan), "outlier_frequency": np.zeros(n)}
+                for method in methods}
+
+    indices =bootstrap_indices(n, n_replicates, seed) if kind == "bootstrap" else jackknife_indices(n)
+    replicates = _replicate_thresholds(values, indices, alphas, methods, block_size)
+
+    tail = (1 - confidence) / 2
+    intervals = {}
+    for method in methods:
+        threshold, thresholds = estimates[method][0], replicates[method]
+        finite = thresholds[np.isfinite(thresholds)]
+
+        if kind == "bootstrap":
+            std = np.std(finite, ddof=1) if len(finite) > 1 else np.nan
+            low, high = np.percentile(finite, [100 * tail, 100 * (1 - tail)]) if len(finite) else (np.nan, np.nan)
+        else:
+            std = np.sqrt((n - 1) / n * np.sum((finite - finite.mean()) ** 2)) if len(finite) else np.nan
+            z = st.norm.ppf(1 - tail)
+            low, high = threshold - z * std, threshold + z * std
+
+        # residual >= threshold is an outlier: count the replicate thresholds <= each residual
+        frequency = np.searchsorted(np.sort(finite), values, side="right") / max(len(finite), 1)
+
+        intervals[method] = {"threshold": threshold, "low": low, "high": high, "std": std,
+                             "replicates": thresholds, "outlier_frequency": frequency}
+
+    return intervals
+
+
+def batch_resample_thresholds(vectors, kind="bootstrap", n_replicates=1000, confidence=0.95,
+                              alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 },
+                              methods=METHODS, seed=None, block_size=2 ** 21):
+    """resample_thresholds of a list of residual vectors (e.g. the inlier curves of all the models of the dataset), the
+    bootstrap of vector v seeded with (seed, v) so that each result does not depend on the others."""
+    return [resample_thresholds(v, kind, n_replicates, confidence, alphas, methods,
+                                None if seed is None else (seed, i), block_size)
+            for i, v in enumerate(vectors)]
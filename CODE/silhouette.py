@@ -0,0 +1,82 @@
+import numpy as np
+
+
+######## 1D distances from sorted values and prefix sums
+
+def sum_abs_difference(x, values):
+    """
+    sum_j |x_i - values_j| for every query x_i. Since the values are 1D, the sum of the distances is obtained from the
+    sorted values and their prefix sums, O((n + q) log n) instead of O(n * q).
+
+    Args:
+    x: 1D array of queries
+    values: 1D array of values
+
+    Returns:
+    sums: 1D array of the same length of x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    v = np.sort(np.asarray(values, dtype=np.float64))
+    n = len(v)
+
+    prefix = np.concatenate(([0], np.cumsum(v)))
+    k = np.searchsorted(v, x)  # number of values below each query
+
+    below = x * k - prefix[k]
+    above = (prefix[-1] - prefix[k]) - x * (n - k)
+
+    return below + above
+
+
+def mean_abs_difference(x, values):
+    """mean_j |x_i - values_j| for every query x_i (nan if values is empty), see sum_abs_difference."""
+    n = len(values)
+    if n == 0:
+        return np.full(len(x), np.nan)
+    return sum_abs_difference(x, values) / n
+
+
+######## Silhouette of 1D data
+
+def silhouette_samples_1d(values, labels):
+    """
+    Silhouette coefficient of each sample for 1D data, same result of sklearn.metrics.silhouette_samples(values.reshape(-1, 1), labels)
+    without the n x n matrix of pairwise distances: O(k n log n) for k clusters.
+
+    Args:
+    values: 1D array of the data points (e.g. the residuals)
+    labels: cluster label of each data point
+
+    Returns:
+    silhouette_values: 1D array with the silhouette coefficient of each data point
+    """
+    x = np.asarray(values, dtype=np.float64).ravel()
+    uniques, lab = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    n, k = len(x), len(uniques)
+    if not 2 <= k <= n - 1:
+        raise ValueError("Number of labels is %d. Valid values are 2 to n_samples - 1 (inclusive)" % k)
+
+    counts = np.bincount(lab, minlength=k)
+
+    intra_cluster = np.zeros(n)
+    inter_cluster = np.full(n, np.inf)
+
+    for cluster in range(k):
+        members = lab == cluster
+        sums = sum_abs_difference(x, x[members])
+
+        # the point itself is in its cluster at distance 0, so it is excluded dividing by count - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intra_cluster[members] = sums[members] / (counts[cluster] - 1)
+        inter_cluster[~members] = np.minimum(inter_cluster[~members], sums[~members] / counts[cluster])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        silhouette_values = (inter_cluster - intra_cluster) / np.maximum(intra_cluster, inter_cluster)
+
+    # single point clusters have silhouette 0, as in sklearn
+    return np.nan_to_num(silhouette_values)
+
+
+def silhouette_score_1d(values, labels):
+    """Average silhouette of 1D data, same result of sklearn.metrics.silhouette_score(values.reshape(-1, 1), labels)."""
+    return float(np.mean(silhouette_samples_1d(values, labels)))
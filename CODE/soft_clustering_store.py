@@ -0,0 +1,263 @@
+"""Compact on-disk format of the corrected dataset (soft clustering of the AdelaideRMF scenes).
+
+A single file holds any number of scenes:
+
+    b"SOFTCLU1" | uint64 little endian length of the header | json header | arrays, each aligned to 64 bytes
+
+The header describes the scenes (type, number of points and models, provenance) and the dtype, shape and offset of
+each array, so a reader maps the file and gets any array, or rows of it, without reading the rest. The arrays of a
+scene, one row for each inlier point of the original scene (the rows of build_residual_matrix):
+
+    membership   uint8 (M, ceil(N/8))   soft clustering, bit-packed along the points (np.packbits, big bit order)
+    partition    float32 (N, M)          partition matrix
+    residuals    float32 (N, M)          residual matrix
+    coordinates  float64 (N, 4)          x1, y1, x2, y2 of the original points
+    labels       uint8 (N, )             original label of the point
+    indices      int32 (N, )             column of the point in data["data"]
+
+Usage:
+    python soft_clustering_store.py --dataset ../DATASET --output adelaide_soft.scf --workers 4
+
+    store = SoftClusteringStore("adelaide_soft.scf")
+    store.membership("H/unihouse", rows=slice(0, 100))    # (100, M) 0/1, scenes are keyed "<type>/<name>"
+    store.load("FM/biscuitbookbox")["partition"]
+"""
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+import scipy.io as spi
+
+
+MAGIC = b"SOFTCLU1"
+VERSION = 1
+ALIGNMENT = 64
+
+ARRAYS = {"membership": "|u1", "partition": "<f4", "residuals": "<f4", "coordinates": "<f8", "labels": "|u1",
+          "indices": "<i4"}
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_builtin(value):
+    # numpy values in the provenance
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+######## Writing
+
+def scene_record(data, result, type='H', provenance=None):
+    """
+    Arrays of a scene in the layout of the file.
+
+    Args:
+      data : scene as loaded from the .mat file
+      result : dictionary with "soft_clustering", "partition_matrix", "residual_matrix" (N,M) and "thresholds", as
+               returned by dataset_runner.run_scene_H / run_scene_FM
+      type : 'H' or 'FM'
+      provenance : dictionary of json values stored with the scene (method, alphas, ...), the thresholds are added
+
+    Returns:
+      record : dictionary accepted by write_store
+    """
+    label = np.ravel(data["label"])
+    indices = np.nonzero(label != 0)[0]
+    coordinates = np.asarray(data["data"])[[0, 1, 3, 4]][:, indices].T
+
+    membership = np.asarray(result["soft_clustering"]) != 0
+    assert membership.shape[0] == len(indices), "one row of the soft clustering for each inlier of the scene"
+
+    provenance = dict(provenance or {})
+    provenance["thresholds"] = np.asarray(result["thresholds"], dtype=np.float64).tolist()
+    if "thresholds_sed" in result:
+        provenance["thresholds_sed"] = np.asarray(result["thresholds_sed"], dtype=np.float64).tolist()
+
+    return {"type": type,
+            "membership": np.packbits(membership.T, axis=1),
+            "partition": np.asarray(result["partition_matrix"], dtype=np.float32),
+            "residuals": np.asarray(result["residual_matrix"], dtype=np.float32),
+            "coordinates": coordinates,
+            "labels": label[indices],
+            "indices": indices,
+            "n_points": membership.shape[0],
+            "n_models": membership.shape[1],
+            "provenance": provenance}
+
+
+def write_store(path, records, provenance=None):
+    """
+    Write the scenes in a single file.
+
+    Args:
+      path : output file
+      records : dictionary {scene name: record}, records from scene_record
+      provenance : dictionary of json values describing the whole file
+    """
+    header = {"version": VERSION,
+              "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+              "provenance": provenance or {},
+              "scenes": {}}
+
+    # offsets relative to the end of the header, the header is written first
+    blocks, offset = [], 0
+    for name, record in records.items():
+        entry = {key: record[key] for key in ("type", "n_points", "n_models", "provenance")}
+        entry["arrays"] = {}
+        for key, dtype in ARRAYS.items():
+            array = np.ascontiguousarray(record[key], dtype=dtype)
+            offset = _aligned(offset)
+            entry["arrays"][key] = {"dtype": dtype, "shape": list(array.shape), "offset": offset}
+            blocks.append((offset, array))
+            offset += array.nbytes
+        header["scenes"][name] = entry
+
+    encoded = json.dumps(header, default=_to_builtin).encode("utf-8")
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(encoded)).astype("<u8").tobytes())
+        f.write(encoded)
+        for block_offset, array in blocks:
+            f.write(b"\0" * (start + block_offset - f.tell()))
+            f.write(array.tobytes())
+
+
+######## Reading
+
+class SoftClusteringStore:
+
+    def __init__(self, path):
+        """Memory map of a file written by write_store: nothing is read until an array is requested."""
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a soft clustering file" % path)
+            length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            self.header = json.loads(f.read(length).decode("utf-8"))
+        if self.header["version"] > VERSION:
+            raise ValueError("Unsupported version %d of the soft clustering file" % self.header["version"])
+
+        self.path = path
+        self._start = _aligned(len(MAGIC) + 8 + length)
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+
+    @property
+    def scenes(self):
+        return list(self.header["scenes"])
+
+    def info(self, scene):
+        """Type, number of points and models and provenance of the scene."""
+        return {key: value for key, value in self.header["scenes"][scene].items() if key != "arrays"}
+
+    def _array(self, scene, key):
+        if self._map is None:
+            raise ValueError("I/O operation on a closed soft clustering file")
+        spec = self.header["scenes"][scene]["arrays"][key]
+        return np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=self._map,
+                          offset=self._start + spec["offset"])
+
+    def array(self, scene, key, rows=None):
+        """
+        Rows of a stored array, a read-only view on the file (membership is unpacked, see membership()).
+
+        Args:
+          rows : None for all the points, a slice or an array of row indices
+        """
+        if key == "membership":
+            return self.membership(scene, rows)
+        array = self._array(scene, key)
+        return array if rows is None else array[rows]
+
+    def membership(self, scene, rows=None):
+        """Soft clustering matrix (N,M) of 0/1, uint8. Only the bytes covering the requested rows are unpacked."""
+        n_points = self.header["scenes"][scene]["n_points"]
+        packed = self._array(scene, "membership")
+
+        if rows is None:
+            rows = slice(None)
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(n_points)
+            if step < 0 or stop <= start:
+                return self.membership(scene, np.arange(n_points)[rows])
+            first, last = start, stop - 1
+            selection = slice(None, None, step)
+        else:
+            rows = np.arange(n_points)[rows]
+            if len(rows) == 0:
+                return np.zeros((0, packed.shape[0]), dtype=np.uint8)
+            first, last = rows.min(), rows.max()
+            selection = rows - first
+
+        bits = np.unpackbits(packed[:, first // 8:last // 8 + 1], axis=1)
+        bits = bits[:, first % 8:first % 8 + last - first + 1]
+        return np.ascontiguousarray(bits.T[selection])
+
+    def load(self, scene, rows=None):
+        """All the arrays of the scene (membership unpacked), plus its info."""
+        loaded = {key: self.array(scene, key, rows) for key in ARRAYS}
+        loaded.update(self.info(scene))
+        return loaded
+
+    def close(self):
+        # the mapping is released when the arrays already returned (views on it) are released too
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+######## Bulk export
+
+def export_dataset(path, dataset_dir=None, types=("H", "FM"), workers=None, cv2_threads=1, scenes=None, cache_dir=None):
+    """
+    Run the pipelines of dataset_runner over the scenes of adelH / adelFM and write the corrected dataset.
+
+    Returns:
+      store : the SoftClusteringStore of the written file
+    """
+    import dataset_runner as dr
+
+    dataset_dir = dr.DATASET_DIR if dataset_dir is None else dataset_dir
+    bundle = dr.run_dataset(dataset_dir, types, workers, cv2_threads, scenes, cache_dir=cache_dir)
+
+    records = {}
+    for type in types:
+        alphas = dr.H_ALPHAS if type == 'H' else dr.FM_ALPHAS
+        for path_mat in dr.list_scenes(dataset_dir, type):
+            name = os.path.splitext(os.path.basename(path_mat))[0]
+            if name not in bundle[type]:
+                continue
+            provenance = {"source": os.path.join(dr.SUBFOLDERS[type], os.path.basename(path_mat)),
+                          "method": dr.METHOD,
+                          "residual": "reprojection error" if type == 'H' else "sampson distance",
+                          "alphas": alphas}
+            # scene names are unique within a type, the key of the file is prefixed by the type
+            records["%s/%s" % (type, name)] = scene_record(spi.loadmat(path_mat), bundle[type][name], type, provenance)
+
+    write_store(path, records, provenance={"dataset": "AdelaideRMF", "types": list(types)})
+    return SoftClusteringStore(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the soft clustering of the AdelaideRMF scenes")
+    parser.add_argument("--dataset", default=None, help="folder containing adelH and adelFM")
+    parser.add_argument("--types", nargs="+", default=["H", "FM"], choices=["H", "FM"])
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--scenes", nargs="*", default=None, help="scene names to export (default: all)")
+    parser.add_argument("--cache", default=None, help="folder of the model cache")
+    parser.add_argument("--output", default="adelaide_soft.scf", help="output file")
+    args = parser.parse_args()
+
+    store = export_dataset(args.output, args.dataset, args.types, args.workers, scenes=args.scenes, cache_dir=args.cache)
+    print("Saved", len(store.scenes), "scenes to", args.output, "(%d bytes)" % os.path.getsize(args.output))
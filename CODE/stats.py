@@ -6,12 +6,13 @@ from sklearn.cluster import DBSCAN
 from scipy import stats
 import matplotlib.pyplot as plt
 from sklearn.ensemble import IsolationForest
-from sklearn.metrics import silhouette_samples, silhouette_score, mean_squared_error
+from sklearn.metrics import mean_squared_error
 from sklearn.linear_model import LinearRegression
 import matplotlib.cm as cm
 from sklearn.preprocessing import StandardScaler
 
 from utils import *
+from silhouette import mean_abs_difference, silhouette_samples_1d, silhouette_score_1d
 from scipy.interpolate import interp1d
 
 
@@ -110,16 +111,32 @@ def First_Jump(values):
 
 ### SN estimation method
 
-def rousseeuwcroux_SN(values, alpha=3):
-    SN = []
+def rousseeuwcroux_SN(values, alpha=3, backend="sorted"):
+    """
+    Sn scale estimator of Rousseeuw and Croux, threshold = median + alpha * Sn.
 
-    for i in range(len(values)):
-        tem = []
-        for j in range(len(values)):
-            if i != j:
-                tem.append(abs(values[i] - values[j]))
+    Args:
+    values: 1D array of residuals
+    alpha: number of Sn over the median for the threshold
+    backend: "sorted" (default) O(n log n) computation on the sorted values, "loop" the original O(n^2) double loop.
+             Both give the same threshold.
+
+    Returns:
+    labels: 1 for outliers, 0 for inliers
+    upper: threshold
+    """
+    if backend == "sorted":
+        SN = _sn_inner_medians(np.sort(np.asarray(values, dtype=np.float64)))
+    else:
+        SN = []
+
+        for i in range(len(values)):
+            tem = []
+            for j in range(len(values)):
+                if i != j:
+                    tem.append(abs(values[i] - values[j]))
 
-        SN.append(np.median(tem))
+            SN.append(np.median(tem))
 
     std_est = c(len(values)) * 1.1926 * np.median(SN)
 
@@ -130,12 +147,29 @@ def rousseeuwcroux_SN(values, alpha=3):
 
 ### QN estimation method
 
-def rousseeuwcroux_QN(values , alpha=3):
+def rousseeuwcroux_QN(values , alpha=3, backend="select"):
+    """
+    Qn scale estimator of Rousseeuw and Croux, threshold = median + alpha * Qn.
+
+    Args:
+    values: 1D array of residuals
+    alpha: number of Qn over the median for the threshold
+    backend: "select" (default) selection of the needed order statistics of the pairwise differences, O(n) memory and
+             O(n log^2 n) time; "outer" the original n x n matrix of differences. Both give the same threshold.
+
+    Returns:
+    labels: 1 for outliers, 0 for inliers
+    upper: threshold
+    """
     n = len(values)
-    A = np.abs(np.subtract.outer(values, values))
-    y = A[np.triu_indices(n, k=1)]
+    if backend == "select":
+        first_quartile = _pairwise_differences_percentile(values, 25)
+    else:
+        A = np.abs(np.subtract.outer(values, values))
+        y = A[np.triu_indices(n, k=1)]
+        first_quartile = np.percentile(y, 25)
     d = _d(n)
-    std_est = d * 2.2219 * np.percentile(y, 25)
+    std_est = d * 2.2219 * first_quartile
 
     upper = np.median(values) + alpha * std_est
 
@@ -143,6 +177,208 @@ def rousseeuwcroux_QN(values , alpha=3):
 
 
 ################################################ auxilary functions
+def _segments(offsets, n):
+    """Given the offsets of a ragged layout (segment s is [offsets[s], offsets[s+1]) of the flat array) it returns for each
+    element of the flat array its segment and the start/end (exclusive) of its segment."""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    seg = np.repeat(np.arange(len(lengths)), lengths)
+    assert len(seg) == n, "offsets do not match the number of values"
+    return seg, offsets[:-1][seg], offsets[1:][seg]
+
+
+def _kth_distance(y, k, offsets=None):
+    """For each i it returns the k-th (1-based, k array or int) smallest value of |y[i] - y[j]|, j != i in the segment of i,
+    where y is sorted inside each segment (a single segment if offsets is None).
+    The distances on the left of i and on the right of i are two sorted sequences, so the k-th smallest of their union is
+    found with a binary search on how many are taken from the left, done for all the i at once: O(n log n)."""
+    n = len(y)
+    i = np.arange(n)
+    k = np.broadcast_to(k, (n,))
+    _, start, end = _segments([0, n] if offsets is None else offsets, n)
+    n_left = i - start
+    n_right = end - 1 - i
+
+    def left(t):  # t-th smallest distance on the left, -inf for t=0 and inf for t>n_left
+        out = np.where(t > n_left, np.inf, y[i] - y[np.clip(i - t, 0, n - 1)])
+        return np.where(t == 0, -np.inf, out)
+
+    def right(t):
+        out = np.where(t > n_right, np.inf, y[np.clip(i + t, 0, n - 1)] - y[i])
+        return np.where(t == 0, -np.inf, out)
+
+    lo = np.maximum(0, k - n_right)
+    hi = np.minimum(k, n_left)
+    # smallest number of left distances a such that the (a+1)-th left distance is not below the (k-a)-th right one
+    while np.any(lo < hi):
+        mid = (lo + hi) // 2
+        take_more = left(mid + 1) < right(k - mid)
+        lo = np.where(take_more & (lo < hi), mid + 1, lo)
+        hi = np.where(~take_more & (lo < hi), mid, hi)
+
+    return np.maximum(left(lo), right(k - lo))
+
+
+def _sn_inner_medians(y, offsets=None):
+    """med_{j != i} |x_i - x_j| for every i (np.median convention, mean of the two central values for an even count).
+    y is sorted inside each segment, the median is taken inside the segment of i; nan for single element segments."""
+    n = len(y)
+    seg, start, end = _segments([0, n] if offsets is None else offsets, n)
+    m = end - start - 1
+
+    first = _kth_distance(y, np.maximum((m + 1) // 2, 1), offsets)
+    second = _kth_distance(y, m // 2 + 1, offsets)
+    inner = np.where(m % 2 == 1, first, (first + second) / 2)
+
+    return np.where(m < 1, np.nan, inner)
+
+
+def _pairwise_differences_rank(y, end, pivot, strict):
+    """For each i the index of the first j > i (j < end[i]) such that y[j] - y[i] >= pivot[i] (strict) or > pivot[i], y sorted
+    inside each segment. The differences of a row are monotone in j, so a binary search is done for all the rows at once."""
+    n = len(y)
+    lo = np.arange(n) + 1
+    hi = np.array(end)
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi) // 2
+        diff = y[np.minimum(mid, n - 1)] - y
+        below = diff < pivot if strict else diff <= pivot
+        lo = np.where(active & below, mid + 1, lo)
+        hi = np.where(active & ~below, mid, hi)
+    return lo
+
+
+def _kth_pairwise_difference(y, k, offsets=None):
+    """k-th smallest (1-based, one k per segment) of the differences y[j] - y[i], i < j, of each segment of y (sorted inside
+    each segment), without building them. The differences of a segment form a matrix with sorted rows: at each step the
+    weighted median of the row midpoints is used as pivot, the elements below/above it are counted row by row and the
+    candidate range of each row is shrunk accordingly (Johnson and Mizoguchi selection, the same scheme used by Croux and
+    Rousseeuw for Qn). All the segments are processed together, nan for segments with less than k differences."""
+    n = len(y)
+    offsets = np.array([0, n] if offsets is None else offsets)
+    lengths = np.diff(offsets)
+    n_seg = len(lengths)
+    seg, _, end = _segments(offsets, n)
+    k = np.broadcast_to(k, (n_seg,))
+
+    i = np.arange(n)
+    left = i + 1  # first candidate column of each row
+    right = end - 1  # last candidate column of each row
+
+    result = np.full(n_seg, np.nan)
+    active = (k >= 1) & (k <= lengths * (lengths - 1) // 2)
+
+    while np.any(active):
+        sizes = np.where(active[seg], np.maximum(right - left + 1, 0), 0)
+        remaining = np.bincount(seg, sizes, minlength=n_seg).astype(np.int64)
+
+        # few candidates left: they are listed and sorted
+        small = active & (remaining <= lengths)
+        if np.any(small):
+            rows = i[small[seg] & (sizes > 0)]
+            counts = sizes[rows]
+            cols = np.repeat(left[rows] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            rows = np.repeat(rows, counts)
+            order = np.lexsort((y[cols] - y[rows], seg[rows]))
+            candidates = (y[cols] - y[rows])[order]
+
+            first = np.concatenate(([0], np.cumsum(remaining[small])))[:-1]
+            n_skipped = np.bincount(seg, left - i - 1, minlength=n_seg).astype(np.int64)[small]
+            result[small] = candidates[first + k[small] - n_skipped - 1]
+            active &= ~small
+            sizes[small[seg]] = 0
+            if not np.any(active):
+                break
+
+        # weighted median of the midpoints of the rows of each segment
+        rows = i[sizes > 0]
+        mid_values = y[(left[rows] + right[rows]) // 2] - y[rows]
+        order = np.lexsort((mid_values, seg[rows]))
+        rows, mid_values = rows[order], mid_values[order]
+        weights = np.cumsum(sizes[rows])
+        active_seg = np.where(active)[0]
+        segment_first = np.searchsorted(seg[rows], active_seg)
+        base = weights[segment_first] - sizes[rows][segment_first]
+        pivot = np.full(n_seg, np.nan)
+        pivot[active_seg] = mid_values[np.searchsorted(weights, base + remaining[active_seg] / 2)]
+
+        first_not_below = _pairwise_differences_rank(y, end, pivot[seg], strict=True)
+        first_above = _pairwise_differences_rank(y, end, pivot[seg], strict=False)
+        n_below = np.bincount(seg, first_not_below - i - 1, minlength=n_seg)
+        n_not_above = np.bincount(seg, first_above - i - 1, minlength=n_seg)
+
+        go_left = active & (k <= n_below)
+        found = active & ~go_left & (k <= n_not_above)
+        go_right = active & ~go_left & ~found
+
+        result[found] = pivot[found]
+        active &= ~found
+        right = np.where(go_left[seg], np.minimum(right, first_not_below - 1), right)
+        left = np.where(go_right[seg], np.maximum(left, first_above), left)
+
+    return result
+
+
+def _lerp(a, b, gamma):
+    # same interpolation formula used by numpy for the linear percentile
+    diff_b_a = b - a
+    return np.where(gamma >= 0.5, b - diff_b_a * (1 - gamma), a + diff_b_a * gamma)
+
+
+def _pairwise_differences_percentile(values, q, offsets=None):
+    """np.percentile(|x_i - x_j| for i < j, q) (default linear interpolation) computed from two order statistics.
+    With offsets, one percentile for each segment of the flat array values (nan for segments with less than 2 values)."""
+    n = len(values)
+    segment_offsets = np.array([0, n] if offsets is None else offsets)
+    y = _segment_sort(values, segment_offsets)
+    lengths = np.diff(segment_offsets)
+    m = lengths * (lengths - 1) // 2
+
+    virtual_index = (q / 100) * (m - 1)
+    low = np.floor(virtual_index).astype(np.int64)
+    gamma = virtual_index - low
+    a = _kth_pairwise_difference(y, low + 1, segment_offsets)
+    b = np.where(low + 1 < m, _kth_pairwise_difference(y, low + 2, segment_offsets), a)
+
+    percentile = np.where(m > 0, _lerp(a, b, gamma), np.nan)
+    return percentile[0] if offsets is None else percentile
+
+
+def _segment_sort(values, offsets):
+    """values sorted inside each segment of the ragged layout."""
+    values = np.asarray(values, dtype=np.float64)
+    seg, _, _ = _segments(offsets, len(values))
+    return values[np.lexsort((values, seg))]
+
+
+def _segment_order_statistics(y, offsets, k):
+    """y[offsets[s] + k[s]] for each segment s of y (0-based k, clipped inside the segment), nan for empty segments."""
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+    result = np.full(len(lengths), np.nan)
+    result[non_empty] = y[offsets[:-1][non_empty] + np.clip(k, 0, lengths - 1)[non_empty]]
+    return result
+
+
+def _segment_percentile(y, offsets, q):
+    """np.percentile(segment, q) of each segment of y, sorted inside each segment. nan for empty segments."""
+    lengths = np.diff(offsets)
+    virtual_index = (q / 100) * (lengths - 1)
+    low = np.floor(virtual_index).astype(np.int64)
+    gamma = virtual_index - low
+    return _lerp(_segment_order_statistics(y, offsets, low), _segment_order_statistics(y, offsets, low + 1), gamma)
+
+
+def _segment_median(y, offsets):
+    """np.median(segment) of each segment of y, sorted inside each segment. nan for empty segments."""
+    lengths = np.diff(offsets)
+    a = _segment_order_statistics(y, offsets, (lengths - 1) // 2)
+    b = _segment_order_statistics(y, offsets, lengths // 2)
+    return np.where(lengths % 2 == 1, a, (a + b) / 2)
+
+
 def _d(n):
     table = [1, 0.399, 0.994, 0.512, 0.844, 0.611, 0.857, 0.669, 0.872]
     if n % 2:
@@ -166,6 +402,87 @@ def c(n):
     return c
 
 
+######## Batched thresholds: many residual vectors (e.g. all the models of all the scenes) in a single vectorized pass
+
+def ragged_layout(vectors):
+    """Given a list of 1D arrays it returns the flat array with all of them one after the other and the offsets,
+    vector v is flat[offsets[v]:offsets[v+1]]."""
+    lengths = [len(v) for v in vectors]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    flat = np.concatenate([np.asarray(v, dtype=np.float64).ravel() for v in vectors]) if len(vectors) else np.zeros(0)
+    return flat, offsets
+
+
+def batch_inlier_thresholds(values, offsets=None, alphas={"Median AD": 2.9 , "Variance based": 1.5 ,"Rosseeuw SN":3,"Rosseeuw QN":3 },
+                            methods=("Median AD", "Variance based", "IQR", "Rosseeuw SN", "Rosseeuw QN"), return_labels=True):
+    """
+    Thresholds of a ragged collection of residual vectors, all the vectors at once: same thresholds of
+    Median_Absolute_Deviation, Variance_based, interquantile_outlier, rousseeuwcroux_SN and rousseeuwcroux_QN applied to
+    each vector (up to floating point rounding for the variance based one).
+
+    Args:
+    values: flat 1D array with the residual vectors one after the other, or a list of 1D arrays (offsets=None)
+    offsets: array of shape (V+1,), the vector v is values[offsets[v]:offsets[v+1]]
+    alphas: alpha of each method, same dictionary used by Inlier_Thresholder
+    methods: methods to compute, names as in Inlier_Thresholder
+    return_labels: if False the labels are not computed (None is returned)
+
+    Returns:
+    thresholds: dictionary method -> numpy array of shape (V,) with the threshold of each vector (nan for empty vectors)
+    labels: dictionary method -> list of V arrays with the labels of each vector, 1 for outliers, 0 for inliers
+    """
+    if offsets is None:
+        values, offsets = ragged_layout(values)
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    seg, _, _ = _segments(offsets, len(values))
+
+    y = _segment_sort(values, offsets)
+    median = _segment_median(y, offsets)
+
+    thresholds = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for method in methods:
+            if method == "Median AD":
+                deviations = _segment_sort(np.abs(values - median[seg]), offsets)
+                mad = _segment_median(deviations, offsets) / 0.6744897501960817  # scale='normal' of scipy
+                thresholds[method] = median + alphas["Median AD"] * mad
+
+            elif method == "Variance based":
+                mean = np.bincount(seg, values, minlength=len(lengths)) / lengths
+                std = np.sqrt(np.bincount(seg, (values - mean[seg]) ** 2, minlength=len(lengths)) / lengths)
+                thresholds[method] = mean + alphas["Variance based"] * std
+
+            elif method == "IQR":
+                Q1 = _segment_percentile(y, offsets, 25)
+                Q3 = _segment_percentile(y, offsets, 75)
+                thresholds[method] = Q3 + 1.5 * (Q3 - Q1)
+
+            elif method == "Rosseeuw SN":
+                inner = _segment_sort(_sn_inner_medians(y, offsets), offsets)
+                correction = np.array([c(n) for n in lengths])
+                std_est = correction * 1.1926 * _segment_median(inner, offsets)
+                thresholds[method] = median + alphas["Rosseeuw SN"] * std_est
+
+            elif method == "Rosseeuw QN":
+                correction = np.array([_d(n) for n in lengths])
+                first_quartile = _pairwise_differences_percentile(values, 25, offsets)
+                std_est = correction * 2.2219 * first_quartile
+                thresholds[method] = median + alphas["Rosseeuw QN"] * std_est
+
+            else:
+                raise ValueError(f"{method} is not available in the batched version")
+
+    if not return_labels:
+        return thresholds, None
+
+    labels = {method: np.split(abs((values < upper[seg]).astype(int) - 1), offsets[1:-1])
+              for method, upper in thresholds.items()}
+
+    return thresholds, labels
+
+
 ####### just the plot of the silhouette
 def silhouette_analysis(values, labels):
     fig, (ax1, ax2) = plt.subplots(1, 2)
@@ -181,8 +498,8 @@ def silhouette_analysis(values, labels):
     # plots of individual clusters, to demarcate them clearly.
     ax1.set_ylim([0, len(X) + (2 + 1) * 10])
 
-    silhouette_avg = silhouette_score(X, labels)
-    sample_silhouette_values = silhouette_samples(X, labels)
+    sample_silhouette_values = silhouette_samples_1d(values, labels)
+    silhouette_avg = np.mean(sample_silhouette_values)
     y_lower = 10
     for i in range(2):
         # Aggregate the silhouette scores for samples belonging to
@@ -247,9 +564,9 @@ def silhouette_score_and_average(values, labels):
             - The silhouette score for each data point as a NumPy array.
             - The average silhouette score.
     """
-    X = values.reshape(-1, 1)  # Reshape for silhouette_score
-    silhouette_values = silhouette_samples(X, labels)
-    silhouette_avg = silhouette_score(X, labels)
+    X = values.reshape(-1, 1)
+    silhouette_values = silhouette_samples_1d(values, labels)  # 1D data: O(n log n), same values of sklearn
+    silhouette_avg = np.mean(silhouette_values)
     return silhouette_values, silhouette_avg, X
 
 
@@ -258,10 +575,15 @@ def plot_silhouette(silhouette_values, labels, silhouette_avg, values, threhsold
     This function creates the silhouette plot and cluster visualization.
 
     Args:
-        silhouette_values: Silhouette score for each data point as a NumPy array.
+        silhouette_values: Silhouette score for each data point as a NumPy array. If None it is computed from values and labels.
         labels: The cluster labels for each data point.
-        silhouette_avg: The average silhouette score.
+        silhouette_avg: The average silhouette score. If None it is computed from values and labels.
     """
+    if silhouette_values is None:
+        silhouette_values = silhouette_samples_1d(values, labels)
+    if silhouette_avg is None:
+        silhouette_avg = np.mean(silhouette_values)
+
     fig, (ax1, ax2) = plt.subplots(1, 2)
     fig.set_size_inches(18, 7)
 
@@ -351,28 +673,19 @@ def AWCD(residual_matrix , partition_matrix,fuzzifier=2):  # the lower the bette
     Returns:
     - AWCD 
     """
-    N,c=residual_matrix.shape[0],residual_matrix.shape[1]
-    
-    AWCD=0
-    
-    for i in range(c):
-        numerator=0
-        denominator=0
-        
-        for j in range(N):
-            denominator+=partition_matrix[j,i]**fuzzifier
-            numerator+=(residual_matrix[j,i]**2)*partition_matrix[j,i]**fuzzifier
-            
-        
-        AWCD+=(1/c)* numerator/denominator
-    return AWCD
+    weights = np.asarray(partition_matrix) ** fuzzifier
+
+    # one weighted mean of the squared residuals per model, then averaged over the c models
+    within = np.sum((np.asarray(residual_matrix) ** 2) * weights, axis=0) / np.sum(weights, axis=0)
+
+    return np.mean(within)
     
     
     
 #########################################  Fuzzy silhouette
 def Fuzzy_silhouette(residual_matrix , partition_matrix ,alpha=1, fuzzifier=2): # the larger the better
     """
-    Compute the Avarage within-cluster distance
+    Compute the Fuzzy silhouette
 
     Parameters:
     - residual_matrix
@@ -381,62 +694,43 @@ def Fuzzy_silhouette(residual_matrix , partition_matrix ,alpha=1, fuzzifier=2):
     - alpha ----- alpha is a user defined parameter, by default alpha=1 is used
     
     Returns:
-    - AWCD 
+    - FS 
     """
     
-    
+    residual_matrix = np.asarray(residual_matrix, dtype=np.float64)
+    partition_matrix = np.asarray(partition_matrix)
+
     N=partition_matrix.shape[0]
     c=partition_matrix.shape[1]
     if c==1: return 1  # single model
     
-    labels=np.zeros(N)
-
-    for i in range(N):
-        labels[i]=np.argmax(partition_matrix[i,:])
-        
-    # compute silhouette values using the hard clustering
+    labels=np.argmax(partition_matrix, axis=1)
         
+    # compute silhouette values using the hard clustering: distances are 1D per model, so the mean distance from a
+    # cluster comes from the sorted residuals of the cluster (see silhouette.mean_abs_difference)
+
     avarage_intracluster_distance=np.zeros(N)
-    for i in range(N):
-        l=labels[i].astype(int)
-        avarage_intracluster_distance[i]=np.mean(abs(residual_matrix[i,l]-residual_matrix[np.where(labels==l),l]))
-        
-    
-        
     avarage_intercluster_distance=np.zeros(partition_matrix.shape)+np.inf
-    
-    for i in range(N):
-        l=labels[i]
-        for j in range(c):
-            if j!=l: avarage_intercluster_distance[i,j]=np.mean(abs(residual_matrix[i,j]-residual_matrix[np.where(labels==j),j]))
-                
-                
-    si=np.zeros(N)
-    for i in range(N):
-        a=avarage_intracluster_distance[i]
-        b=np.min(avarage_intercluster_distance[i,:])
-  
-        si[i]=(b-a)/np.max(np.array([a,b]))
-        
 
-        
-    
-    P_mat=partition_matrix.copy()
-    numerator=0
-    denominator=0
-    for i in range(N):
-        mu_p_index=np.argmax(P_mat[i,:])
-        mu_p=P_mat[i,mu_p_index]
-        P_mat[i,mu_p_index]=-np.inf
-        mu_q=np.max(P_mat[i,:])
-        
-        numerator+=((mu_p-mu_q)**alpha) *si[i]
-        denominator+=((mu_p-mu_q)**alpha)
-        
+    for j in range(c):
+        members = labels == j
+        mean_distance = mean_abs_difference(residual_matrix[:, j], residual_matrix[members, j])
 
-        
-    FS=numerator/denominator
-        
+        avarage_intracluster_distance[members] = mean_distance[members]
+        avarage_intercluster_distance[~members, j] = mean_distance[~members]
+
+    a=avarage_intracluster_distance
+    b=np.min(avarage_intercluster_distance, axis=1)
+
+    si=(b-a)/np.maximum(a,b)
+
+    # fuzzy weighting with the difference between the two largest memberships of each point
+    two_largest=np.partition(partition_matrix, c-2, axis=1)[:, -2:]
+    mu_q, mu_p = two_largest[:, 0], two_largest[:, 1]
+
+    weights=(mu_p-mu_q)**alpha
+
+    FS=np.sum(weights*si)/np.sum(weights)
                 
     return FS
 
@@ -486,20 +780,161 @@ def f_test(sample1, sample2):
     return F, p_value
 
 
-def forward_search(residuals, initial_m0=2, initial_percentile=95, alpha=0.01, smoothing_factor=0.95):
+def _closest_window(sorted_values, center, k):
+    """Start of the k consecutive sorted values closest to center: the k values nearest to a point of the line are always
+    contiguous in the sorted order, so the window is found with a binary search on its start."""
+    p = int(np.searchsorted(sorted_values, center))
+    lo, hi = max(0, p - k), min(p, len(sorted_values) - k)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if center - sorted_values[mid] > sorted_values[mid + k] - center:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def forward_search(residuals, initial_m0=2, initial_percentile=95, alpha=0.01, smoothing_factor=0.95,
+                   backend="incremental", return_trajectory=False):
     """
     Perform Forward Search with dynamic adjustment of m0.
 
+    With the default "incremental" backend the residuals are sorted once: at every step the subset is the window of the
+    sorted residuals closest to the mean of the current subset (found by binary search), the subset grows by the points
+    entering the window and its mean and variance are running moments, so the F test costs O(1) against critical values
+    precomputed for every subset size. The whole search is O(n log n). The "sets" backend is the original implementation,
+    which re-sorts the standardized residuals and rebuilds the subset at every step.
+
     Args:
     residuals: array of residuals from the model
     initial_m0: initial number of expected outliers
-    percentile: the percentage of inliers expected
-    alpha: significance level for the chi-square test
+    initial_percentile: the percentage of inliers expected
+    alpha: significance level for the F test
+    smoothing_factor: weight of the previous percentile in the update of the percentile
+    backend: "incremental" (default) or "sets"
+    return_trajectory: if True (only "incremental") also return the monitoring trajectory of the search
 
     Returns:
     outlier_mask: boolean mask indicating outliers (True) and inliers (False)
     threshold: final threshold used for outlier detection
+    trajectory: (only if return_trajectory) dictionary of arrays with one entry per step: "subset_size", "m0", "mean"
+                and "std" of the subset, "F", "p_value", "percentile", plus the sorted residuals ("sorted_residuals")
     """
+    if backend != "incremental":
+        if return_trajectory:
+            raise ValueError("The monitoring trajectory is only available with the incremental backend")
+        return _forward_search_sets(residuals, initial_m0, initial_percentile, alpha, smoothing_factor)
+
+    residuals = np.asarray(residuals, dtype=np.float64)
+    n_samples = len(residuals)
+    max_iter = n_samples - 1
+
+    # The original standardizes the residuals by their MAD: this changes neither the order of the residuals nor the ratio
+    # of the variances of the F test, so the search works directly on the residuals
+
+    order = np.argsort(residuals, kind="stable")
+    sorted_residuals = residuals[order]
+
+    # Initial core set with smallest squared residuals
+    center = np.mean(residuals[np.argsort(residuals ** 2)[:n_samples // 7]]) if n_samples // 7 else np.nan
+
+    # Two sided F test of the subset (size c) against the subset without one point: df1 = c - 1, df2 = c - 2.
+    # p_value < alpha <=> F outside the critical values, computed once for each subset size that is tested
+    critical_values = {}
+
+    # running moments of the subset, shifted by the median to limit the cancellation in the variance
+    shift = sorted_residuals[n_samples // 2] if n_samples else 0.0
+    count, total, total_sq = 0, 0.0, 0.0
+    in_subset = np.zeros(n_samples, dtype=bool)  # on the sorted positions
+    lo_sub, hi_sub, contiguous = 0, 0, True  # the subset is sorted_residuals[lo_sub:hi_sub] while contiguous
+    last_index = -1  # largest original index in the subset, the point left out by the F test
+
+    m0 = initial_m0
+    current_percentile = initial_percentile
+    trajectory = {"subset_size": [], "m0": [], "mean": [], "std": [], "F": [], "percentile": []}
+
+    for iteration in range(max_iter):
+        # the n - m0 residuals closest to the center enter the subset
+        k = max(n_samples - m0, 0) if m0 > 0 else 0
+        if k > 0:
+            start = _closest_window(sorted_residuals, center, k)
+            if count == 0 or (contiguous and start <= hi_sub and start + k >= lo_sub):
+                new = np.r_[start:min(start + k, lo_sub), max(start, hi_sub):start + k] if count else np.arange(start, start + k)
+                lo_sub, hi_sub = (min(start, lo_sub), max(start + k, hi_sub)) if count else (start, start + k)
+            else:
+                new = start + np.flatnonzero(~in_subset[start:start + k])
+                contiguous = False
+
+            if len(new):
+                in_subset[new] = True
+                values = sorted_residuals[new] - shift
+                count += len(new)
+                total += values.sum()
+                total_sq += np.dot(values, values)
+                last_index = max(last_index, int(order[new].max()))
+                center = shift + total / count
+
+        # Update current percentile
+        new_percentile = np.floor((count / n_samples) * 100)
+        current_percentile = smoothing_factor * current_percentile + (1 - smoothing_factor) * new_percentile
+        current_percentile = np.floor(max(min(current_percentile, 99), 80))  # Constrain between 80 and 99
+
+        var1 = max(total_sq - total * total / count, 0.0) / (count - 1) if count > 1 else np.nan
+        F = np.nan
+
+        # Dynamic adjustment of m0
+        if count > 2:  # Ensure we have enough points for f test
+            left_out = residuals[last_index] - shift
+            total2, total_sq2 = total - left_out, total_sq - left_out * left_out
+            var2 = max(total_sq2 - total2 * total2 / (count - 1), 0.0) / (count - 2)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                F = np.float64(var1) / var2 if var1 >= var2 else np.float64(var2) / var1
+
+            if count not in critical_values:
+                critical_values[count] = stats.f.ppf([alpha / 2, 1 - alpha / 2], count - 1, count - 2)
+            f_low, f_high = critical_values[count]
+
+            if F < f_low or F > f_high:
+                m0 = min(m0 + 1, n_samples - count)
+            else:
+                m0 = max(initial_m0, m0 - 1)
+
+        if return_trajectory:
+            trajectory["subset_size"].append(count)
+            trajectory["m0"].append(m0)
+            trajectory["mean"].append(center)
+            trajectory["std"].append(np.sqrt(var1))
+            trajectory["F"].append(F)
+            trajectory["percentile"].append(current_percentile)
+
+        # Stopping criterion
+        if n_samples == 0 or count + m0 == n_samples:
+            break
+
+    # Final threshold computation
+    threshold = np.percentile(np.abs(residuals), current_percentile)
+
+    # Create outlier mask
+    outlier_mask = np.abs(residuals) > threshold
+
+    if not return_trajectory:
+        return outlier_mask, float(threshold)
+
+    trajectory = {key: np.array(value, dtype=np.float64) for key, value in trajectory.items()}
+    trajectory["subset_size"] = trajectory["subset_size"].astype(int)
+    trajectory["m0"] = trajectory["m0"].astype(int)
+
+    with np.errstate(invalid='ignore'):
+        cdf = stats.f.cdf(trajectory["F"], trajectory["subset_size"] - 1, trajectory["subset_size"] - 2)
+    trajectory["p_value"] = 2 * np.minimum(cdf, 1 - cdf)
+    trajectory["sorted_residuals"] = sorted_residuals
+
+    return outlier_mask, float(threshold), trajectory
+
+
+def _forward_search_sets(residuals, initial_m0=2, initial_percentile=95, alpha=0.01, smoothing_factor=0.95):
+    """Original forward search, see forward_search(backend="sets")."""
     n_samples = len(residuals)
     max_iter = n_samples - 1
 
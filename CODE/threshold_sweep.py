@@ -0,0 +1,128 @@
+"""Inlier curves of a residual matrix over whole grids of thresholds, without refitting.
+
+Every column of the residual matrix is sorted once: the number of inliers at any threshold is then a searchsorted and
+the mean inlier residual a lookup in the cumulative sums. For the quantities that depend on all the models together
+(overlap of the soft assignment, misclassification w.r.t. the ground truth) the models are swept together, step t of
+the grid using the t-th threshold of every model: each point-model pair enters the soft assignment at the first step
+whose threshold is above the residual, and the curves are cumulative counts of these steps.
+
+Inliers follow soft_clustering_assignment, residual < threshold:
+
+    res = build_residual_matrix(data, type='H')
+    sweep = sweep_thresholds(res, threshold_grid(res, 1000), labels=ground_truth_labels(data))
+    sweep["inliers"][m, t]  ==  soft_clustering_assignment(res, sweep["thresholds"][:, t])[:, m].sum()
+"""
+import numpy as np
+
+
+def ground_truth_labels(data):
+    """Labels of the rows of build_residual_matrix(data): the model (1, 2, ...) of every inlier point of the scene."""
+    label = np.ravel(data["label"])
+    return label[label != 0]
+
+
+def threshold_grid(residual_matrix, n_thresholds=1000, max_percentile=100):
+    """
+    Per model grid of thresholds, from 0 to the max_percentile of the finite residuals of the column.
+
+    Returns:
+      thresholds : array (M, n_thresholds), increasing along the rows
+    """
+    residual_matrix = np.asarray(residual_matrix, dtype=np.float64)
+    finite = np.where(np.isfinite(residual_matrix), residual_matrix, np.nan)
+    top = np.nanpercentile(finite, max_percentile, axis=0)
+    top = np.where(np.isfinite(top) & (top > 0), top, 1)
+    # slightly above the top residual, so that the last threshold includes it (residual < threshold)
+    return np.linspace(0, 1, n_thresholds)[None, :] * np.nextafter(top, np.inf)[:, None]
+
+
+def _entry_steps(residual_matrix, thresholds):
+    # (N, M) first step t of the grid with residual < thresholds[m, t], T if none
+    entry = np.empty(residual_matrix.shape, dtype=np.int64)
+    for m in range(residual_matrix.shape[1]):
+        entry[:, m] = np.searchsorted(thresholds[m], residual_matrix[:, m], side="right")
+    return entry
+
+
+def _steps_count(steps, n_steps):
+    # number of steps <= t, for every t of the grid
+    return np.cumsum(np.bincount(np.ravel(steps), minlength=n_steps + 1))[:n_steps]
+
+
+def sweep_thresholds(residual_matrix, thresholds, labels=None):
+    """
+    Inlier curves of every model for a grid of thresholds.
+
+    Args:
+      residual_matrix : numpy array of shape (N,M), N=number of points, M=number of models
+      thresholds : grid of T thresholds, shape (T,) shared by all the models or (M,T) one grid per model (sorted)
+      labels : optional ground truth of the rows, shape (N,): j + 1 for the points of model j, 0 for outliers
+               (ground_truth_labels(data) for the residual matrix of build_residual_matrix)
+
+    Returns:
+      sweep : dictionary of numpy arrays
+              - "thresholds" : (M,T) the grid, sorted
+              - "inliers" : (M,T) number of points with residual < threshold
+              - "mean_error" : (M,T) mean residual of the inliers, nan without inliers
+              - "overlap" : (T,) number of points inlier to more than one model at step t
+              - "unassigned" : (T,) number of points inlier to no model at step t
+              with labels also
+              - "false_positives" : (M,T) inliers of a model from other models (or outliers)
+              - "false_negatives" : (M,T) points of a model that are not its inliers
+              - "misclassification" : (T,) fraction of points whose soft assignment is not exactly the ground truth
+    """
+    residual_matrix = np.asarray(residual_matrix, dtype=np.float64)
+    n_points, n_models = residual_matrix.shape
+
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if thresholds.ndim == 1:
+        thresholds = np.broadcast_to(thresholds, (n_models, len(thresholds)))
+    assert thresholds.shape[0] == n_models, "number of models in residual matrix different from number of grids"
+    thresholds = np.sort(thresholds, axis=1)
+    n_steps = thresholds.shape[1]
+
+    # one sort per column, then searchsorted for all the thresholds
+    sorted_residuals = np.sort(residual_matrix, axis=0)
+    inliers = np.empty((n_models, n_steps), dtype=np.int64)
+    for m in range(n_models):
+        inliers[m] = np.searchsorted(sorted_residuals[:, m], thresholds[m], side="left")
+
+    cumulative = np.vstack((np.zeros((1, n_models)), np.cumsum(sorted_residuals, axis=0))).T  # (M, N+1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_error = np.take_along_axis(cumulative, inliers, axis=1) / inliers
+    mean_error[inliers == 0] = np.nan
+
+    entry = _entry_steps(residual_matrix, thresholds)
+    first = np.min(entry, axis=1)
+    second = np.partition(entry, 1, axis=1)[:, 1] if n_models > 1 else np.full(n_points, n_steps)
+
+    sweep = {"thresholds": thresholds, "inliers": inliers, "mean_error": mean_error,
+             "overlap": _steps_count(second, n_steps), "unassigned": n_points - _steps_count(first, n_steps)}
+
+    if labels is None:
+        return sweep
+
+    labels = np.ravel(labels).astype(np.int64)
+    assert len(labels) == n_points, "one label for each row of the residual matrix"
+
+    true_positives = np.empty((n_models, n_steps), dtype=np.int64)
+    for m in range(n_models):
+        true_positives[m] = _steps_count(entry[labels == m + 1, m], n_steps)
+    sweep["false_positives"] = inliers - true_positives
+    sweep["false_negatives"] = np.bincount(labels, minlength=n_models + 1)[1:n_models + 1, None] - true_positives
+
+    # a point is correctly assigned from the step it enters its own model (0 for outliers) to the step any other
+    # model takes it
+    own = np.zeros(n_points, dtype=np.int64)
+    others = entry.copy()
+    has_model = (labels >= 1) & (labels <= n_models)
+    rows = np.nonzero(has_model)[0]
+    own[rows] = entry[rows, labels[rows] - 1]
+    others[rows, labels[rows] - 1] = n_steps + 1
+    start, end = own, np.minimum(np.min(others, axis=1), n_steps)
+
+    correct = start < end
+    changes = np.bincount(start[correct], minlength=n_steps + 1) - np.bincount(end[correct], minlength=n_steps + 1)
+    sweep["misclassification"] = 1 - np.cumsum(changes)[:n_steps] / n_points
+
+    return sweep
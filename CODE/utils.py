@@ -1,8 +1,13 @@
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import cv2
 import numpy as np
 import visual as vi
+import instrumentation as ins
+import homography_engine as he
+import fundamental_engine as fe
+import model_cache as mc
 from matplotlib import pyplot as plt
 from stats import *
 import pygcransac
@@ -15,30 +20,160 @@ FITTING_ALGS = {"LMEDS": cv2.LMEDS,
                 "GC-RANSAC": cv2.USAC_ACCURATE,
                 "LO-RANSAC": cv2.USAC_DEFAULT,
                 "PROSAC": cv2.USAC_PROSAC,
-                "MAGSAC": cv2.USAC_MAGSAC}
-
-
-def verify_H(src_points, dst_points, threshold, verbose=True, method="LMEDS"):
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findHomography(src_pts, dst_pts, FITTING_ALGS[method], threshold)
+                "MAGSAC": cv2.USAC_MAGSAC,
+                # NumPy estimators with batched hypotheses (homography_engine), called instead of cv2.findHomography
+                "NP-LMEDS": he.lmeds_homography,
+                "NP-RANSAC": he.ransac_homography,
+                # and instead of cv2.findFundamentalMat (fundamental_engine)
+                "NP-LMEDS_FM": fe.lmeds_fundamental,
+                "NP-RANSAC_FM": fe.ransac_fundamental}
+
+# estimators used by build_ensemble_mask
+ENSEMBLE_ESTIMATORS = ['LMEDS_FM', 'RANSAC_FM', 'GC-RANSAC', 'LO-RANSAC']
+
+
+def correspondence_buffer(src_points, dst_points=None):
+    """Given src points and dst points it returns the contiguous float32 (N,4) buffer [x1, y1, x2, y2] used by the estimators.
+    If dst_points is None, src_points is already expected to be a (N,4) correspondence buffer and it is not copied when it
+    is contiguous float32."""
+    if dst_points is None:
+        return np.ascontiguousarray(src_points, dtype=np.float32).reshape(-1, 4)
+    return np.ascontiguousarray(np.hstack((np.reshape(src_points, (-1, 2)), np.reshape(dst_points, (-1, 2)))),
+                                dtype=np.float32)
+
+
+def fitting_points(src_points, dst_points=None):
+    """Given src points and dst points (Nx2 each) or a single (N,4) correspondence buffer, it returns the float32 (N,1,2)
+    arrays expected by cv2.findHomography and cv2.findFundamentalMat. Contiguous float32 inputs are only reshaped."""
+    if dst_points is None:
+        correspondences = correspondence_buffer(src_points)
+        src_points, dst_points = correspondences[:, :2], correspondences[:, 2:]
+    src_pts = np.ascontiguousarray(src_points, dtype=np.float32).reshape(-1, 1, 2)
+    dst_pts = np.ascontiguousarray(dst_points, dtype=np.float32).reshape(-1, 1, 2)
+    assert src_pts.shape == dst_pts.shape
+    return src_pts, dst_pts
+
+
+def expected_iterations(method, n_inliers, n_points, sample_size, confidence, max_iters):
+    """Expected number of iterations of a classic OpenCV estimator (LMEDS, RANSAC) from its stopping rule: OpenCV does not
+    report the iterations, this is an estimate, not a measure. LMEDS runs a fixed number of iterations, computed from the
+    confidence assuming 45% of outliers; RANSAC stops when an all inliers sample has been drawn with the given
+    confidence, computed here for the inlier ratio that was found."""
+    inlier_ratio = 0.55 if "LMEDS" in method else n_inliers / max(n_points, 1)
+    if inlier_ratio >= 1:
+        return 1
+    with np.errstate(divide='ignore'):
+        niters = np.log(1 - confidence) / np.log(1 - inlier_ratio ** sample_size)
+    if "LMEDS" in method:
+        niters = max(np.round(niters), 3)
+    return int(min(np.ceil(niters), max_iters))
+
+
+# USAC estimators: local optimization and their own stopping rules, the expected iterations are not computed for them
+USAC_ESTIMATORS = ("GC-RANSAC", "LO-RANSAC", "PROSAC", "MAGSAC")
+
+
+def _fit_event(method, mask, n_points, sample_size, confidence, max_iters, verbose, message, samples=None,
+               cached=False):
+    # structured event of an estimator call, printed as before with verbose. samples is the number of minimal samples
+    # of the NumPy estimators (known exactly); for LMEDS / RANSAC the event has the expected_iterations of the stopping rule
     n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found by ' + method)
+    if cached:
+        ins.event("fit", verbose, (n_inliers, message), method=method, points=n_points, inliers=int(n_inliers),
+                  cached=True)
+        ins.count("cache_hits")
+        return
+    fields = {}
+    if samples is not None:
+        fields["samples"] = samples
+    elif sample_size is not None and method not in USAC_ESTIMATORS:
+        fields["expected_iterations"] = expected_iterations(method, n_inliers, n_points, sample_size, confidence,
+                                                            max_iters)
+    ins.event("fit", verbose, (n_inliers, message), method=method, points=n_points, inliers=int(n_inliers), **fields)
+    ins.count("estimator_calls")
+    ins.count("inliers_found", int(n_inliers))
+
+
+def _cached_fit(model, method, threshold, seed, src_pts, dst_pts, fit):
+    # fit() -> (M, mask, residuals or None), through the active model_cache when there is one. LMEDS ignores the
+    # threshold, so it is not part of its key: changing the thresholds does not refit the LMEDS models
+    cache = mc.active_cache()
+    if cache is None:
+        return fit() + (False,)
+
+    key = mc.cache_key(model, method, None if "LMEDS" in method else threshold, seed, src_pts, dst_pts)
+    entry = cache.get(key)
+    if entry is not None and "M" in entry:
+        return entry["M"], entry["mask"], entry.get("residuals"), True
+
+    M, mask, residuals = fit()
+    if M is not None:
+        cache.put(key, M=M, mask=mask, residuals=residuals)
+    return M, mask, residuals, False
+
+
+def verify_H(src_points, dst_points, threshold, verbose=True, method="LMEDS", return_residuals=False):
+    """Homography of the points with the estimator FITTING_ALGS[method]. With return_residuals the residuals of the points
+    w.r.t. the homography are also returned: the NumPy estimators ("NP-...") give them with the model, for the OpenCV ones
+    they are computed with compute_residual."""
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+
+    def fit():
+        with ins.stage("estimator", method=method):
+            if callable(FITTING_ALGS[method]):
+                H, mask, residuals, _ = FITTING_ALGS[method](src_pts, dst_pts, threshold)
+                return H, mask, residuals
+            return cv2.findHomography(src_pts, dst_pts, FITTING_ALGS[method], threshold) + (None,)
+
+    H, mask, residuals, cached = _cached_fit("H", method, threshold, None, src_pts, dst_pts, fit)
+
+    if callable(FITTING_ALGS[method]):
+        _fit_event(method, mask, len(src_pts), None, None, None, verbose, 'inliers found by ' + method,
+                   samples=he.N_HYPOTHESES, cached=cached)
+    else:
+        _fit_event(method, mask, len(src_pts), 4, 0.995, 2000, verbose, 'inliers found by ' + method, cached=cached)
+
+    if return_residuals:
+        if residuals is None:
+            if dst_points is None: src_points, dst_points = src_pts, dst_pts
+            residuals = compute_residual(np.reshape(src_points, (-1, 2)), np.reshape(dst_points, (-1, 2)), H)
+        return H, mask.ravel(), residuals
     return H, mask.ravel()
 
 
-def verify_FM(src_points, dst_points, threshold, verbose=True, method="LMEDS", seed=None):
+def verify_FM(src_points, dst_points, threshold, verbose=True, method="LMEDS", seed=None, return_residuals=False):
+    """Fundamental matrix of the points with the estimator FITTING_ALGS[method]. With return_residuals the Sampson
+    distances of the points w.r.t. the matrix are also returned: the NumPy estimators ("NP-...") give them with the model,
+    for the OpenCV ones they are computed with compute_sampson_distance."""
     method = method.upper()
-    if method == "LMEDS" or method == "RANSAC": method += "_FM"
+    if method in ("LMEDS", "RANSAC", "NP-LMEDS", "NP-RANSAC"): method += "_FM"
 
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    if "LMEDS" in method: H, mask = cv2.findFundamentalMat(src_pts, dst_pts, FITTING_ALGS[method], threshold, confidence=0.975)
-    else: H, mask = cv2.findFundamentalMat(src_pts, dst_pts, FITTING_ALGS[method], threshold)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found by ' + method)
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+
+    def fit():
+        if seed is not None and not callable(FITTING_ALGS[method]): cv2.setRNGSeed(seed)  # the OpenCV RNG is per thread
+        with ins.stage("estimator", method=method):
+            if callable(FITTING_ALGS[method]):
+                H, mask, residuals, _ = FITTING_ALGS[method](src_pts, dst_pts, threshold, seed=0 if seed is None else seed)
+                return H, mask, residuals
+            if "LMEDS" in method:
+                return cv2.findFundamentalMat(src_pts, dst_pts, FITTING_ALGS[method], threshold, confidence=0.975) + (None,)
+            return cv2.findFundamentalMat(src_pts, dst_pts, FITTING_ALGS[method], threshold) + (None,)
+
+    H, mask, residuals, cached = _cached_fit("FM", method, threshold, seed, src_pts, dst_pts, fit)
+
+    if callable(FITTING_ALGS[method]):
+        _fit_event(method, mask, len(src_pts), None, None, None, verbose, 'inliers found by ' + method,
+                   samples=fe.N_SAMPLES, cached=cached)
+    else:
+        _fit_event(method, mask, len(src_pts), 7, 0.975 if "LMEDS" in method else 0.99, 1000, verbose,
+                   'inliers found by ' + method, cached=cached)
+
+    if return_residuals:
+        if residuals is None:
+            if dst_points is None: src_points, dst_points = src_pts, dst_pts
+            residuals = compute_sampson_distance(src_points, dst_points, H)
+        return H, mask.ravel(), residuals
     return H, mask.ravel()
 
 
@@ -59,9 +194,7 @@ def verify_pygcransac_H(src_points,dst_points, img1,img2,  threshold, confidence
        mask : labels for inlier and outliers    1-inlier ;  0-outlier (numpy array of shape (No_points , )
      """
 
-     kps1,kps2,matches=build_keypts_matches(src_points, dst_points)
-
-     correspondences = np.float32([ (kps1[m.queryIdx].pt + kps2[m.trainIdx].pt) for m in matches ]).reshape(-1,4)
+     correspondences = correspondence_buffer(src_points, dst_points)
      inlier_probabilities = []
 
      h1=img1.shape[1]
@@ -69,18 +202,19 @@ def verify_pygcransac_H(src_points,dst_points, img1,img2,  threshold, confidence
      h2=img2.shape[1]
      w2=img2.shape[0]
 
-     H, mask = pygcransac.findHomography(
-         np.ascontiguousarray(correspondences),
-         h1, w1, h2, w2,
-         use_sprt = False,
-         threshold=threshold,
-         conf=confidence,
-         spatial_coherence_weight =spatial_coherence_weight ,
-         neighborhood_size = neighborhood_size,
-         probabilities = inlier_probabilities,
-         sampler = 0,
-         use_space_partitioning = True)
-     if verbose: print (deepcopy(mask).astype(np.float32).sum(), 'inliers found')
+     with ins.stage("estimator", method="PYGCRANSAC"):
+         H, mask = pygcransac.findHomography(
+             correspondences,
+             h1, w1, h2, w2,
+             use_sprt = False,
+             threshold=threshold,
+             conf=confidence,
+             spatial_coherence_weight =spatial_coherence_weight ,
+             neighborhood_size = neighborhood_size,
+             probabilities = inlier_probabilities,
+             sampler = 0,
+             use_space_partitioning = True)
+     _fit_event("PYGCRANSAC", mask, len(correspondences), None, confidence, None, verbose, 'inliers found')
      return H, mask.astype(np.uint8)
 
 
@@ -102,12 +236,10 @@ def verify_pygcransac_FM(src_points, dst_points, threshold, verbose=True):
       mask : labels for inlier and outliers    1-inlier ;  0-outlier (numpy array of shape (No_points , )
     """
 
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.USAC_ACCURATE, threshold)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found')
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+    with ins.stage("estimator", method="GC-RANSAC"):
+        H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.USAC_ACCURATE, threshold)
+    _fit_event("GC-RANSAC", mask, len(src_pts), 7, 0.99, 1000, verbose, 'inliers found')
     return H, mask.ravel()
 
 
@@ -150,12 +282,10 @@ def verify_cv2_H(src_points, dst_points, ransacReprojThreshold=1, verbose=True):
       mask : labels for inlier and outliers    1-inlier ;  0-outlier (numpy array of shape (No_points , )
     """
 
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransacReprojThreshold)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found')
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+    with ins.stage("estimator", method="RANSAC"):
+        H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransacReprojThreshold)
+    _fit_event("RANSAC", mask, len(src_pts), 4, 0.995, 2000, verbose, 'inliers found')
     return H, mask.ravel()
 
 
@@ -172,32 +302,26 @@ def verify_LMEDS_H(src_points, dst_points, confidence=0.975, verbose=True):
       H : homography, (3x3 numpy matrix)
       mask : labels for inlier and outliers    1-inlier ;  0-outlier (numpy array of shape (No_points , )
     """
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findHomography(src_pts, dst_pts, cv2.LMEDS, confidence=confidence)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found')
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+    with ins.stage("estimator", method="LMEDS"):
+        H, mask = cv2.findHomography(src_pts, dst_pts, cv2.LMEDS, confidence=confidence)
+    _fit_event("LMEDS", mask, len(src_pts), 4, confidence, 2000, verbose, 'inliers found')
     return H, mask.ravel()
 
 
 def verify_cv2_FM(src_points, dst_points, ransacReprojThreshold=1, verbose=True):
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.FM_RANSAC, ransacReprojThreshold)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found')
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+    with ins.stage("estimator", method="RANSAC_FM"):
+        H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.FM_RANSAC, ransacReprojThreshold)
+    _fit_event("RANSAC_FM", mask, len(src_pts), 7, 0.99, 1000, verbose, 'inliers found')
     return H, mask.ravel()
 
 
 def verify_LMEDS_FM(src_points, dst_points, confidence=0.975, verbose=True):
-    kps1, kps2, matches = build_keypts_matches(src_points, dst_points)
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.FM_LMEDS, confidence=confidence)
-    n_inliers = deepcopy(mask).astype(np.float32).sum()
-    if verbose: print(n_inliers, 'inliers found')
+    src_pts, dst_pts = fitting_points(src_points, dst_points)
+    with ins.stage("estimator", method="LMEDS_FM"):
+        H, mask = cv2.findFundamentalMat(src_pts, dst_pts, cv2.FM_LMEDS, confidence=confidence)
+    _fit_event("LMEDS_FM", mask, len(src_pts), 7, confidence, 1000, verbose, 'inliers found')
     return H, mask.ravel()
 
 
@@ -239,8 +363,15 @@ def extract_points(models, data):
       inliers2: numpy array of dim (N,2) with N total number of points. It is a collection of all the points that are inliers in img2.                        Usefull for residual matrix computation
 
       labels of inliers : labels only for the inlier points. So for each point in inliers1 or inliers2 we know specifically its model.
+
+      points["indices"] is also filled: list of arrays, indices[0] are the row indices in inliers1/inliers2 of the points of
+      model 0 (same order as src_points[0]), so results of a model can be mapped back to the whole scene with fancy indexing.
     """
-    points = {"src_points": [], "dst_points": []}
+    l = data["label"]
+    p = data["data"]
+    inl = np.where(l[0] != 0)
+
+    points = {"src_points": [], "dst_points": [], "indices": []}
     for i in range(len(models)):
         src_points = np.array(list(zip(models[i][0], models[i][1])))
 
@@ -248,10 +379,8 @@ def extract_points(models, data):
 
         points["src_points"].append(src_points)
         points["dst_points"].append(dst_points)
+        points["indices"].append(np.where(l[0][inl] == i + 1)[0])
 
-    l = data["label"]
-    p = data["data"]
-    inl = np.where(l[0] != 0)
     inlp1_x = p[0][inl]
     inlp1_y = p[1][inl]
     inlp2_x = p[3][inl]
@@ -264,6 +393,8 @@ def extract_points(models, data):
 
 
 def build_keypts_matches(src_points, dst_points):
+    """cv2.KeyPoint / cv2.DMatch lists for cv2.drawMatches. Only used for drawing, the estimators take the arrays directly
+    (see fitting_points)."""
     src_kpts = [cv2.KeyPoint(x, y, 1) for x, y in src_points]
     dst_kpts = [cv2.KeyPoint(x, y, 1) for x, y in dst_points]
     assert len(src_kpts) == len(dst_kpts)
@@ -297,7 +428,38 @@ def draw_matches(img1, img2, src_points, dst_points, title=None, matchColor=(255
     plt.imshow(img_out)
     return
 
-def build_ensemble_mask(data, plot=False, verbose=True, type='H',threshold=None, mask=None):
+def _fit_ensemble_member(src, dst, threshold, method, seed, verbose):
+    """Residuals of the points w.r.t. the fundamental matrix fitted by a single estimator of the ensemble."""
+    _, _, residuals = verify_FM(src, dst, threshold=threshold, method=method.upper(), verbose=verbose, seed=seed,
+                                return_residuals=True)
+    return residuals
+
+
+def build_ensemble_mask(data, plot=False, verbose=True, type='H',threshold=None, mask=None, estimators=ENSEMBLE_ESTIMATORS,
+                        seeds=None, n_jobs=None, executor=None):
+    """Given the data and the thresholds of the models, it fits the fundamental matrix of each model with every estimator of
+    the ensemble and labels as outliers the points whose residual, averaged over the estimators, is above the threshold.
+
+    Args:
+
+      threshold : list with the threshold of each model
+
+      mask : optional list of masks, only the points with mask 1 of each model are used
+
+      estimators : keys of FITTING_ALGS used in the ensemble
+
+      seeds : one seed for each estimator (default: 0, 1, 2, ...), set with cv2.setRNGSeed in the thread that runs the
+              fit. Only LMEDS_FM and RANSAC_FM use it, the USAC estimators (GC-RANSAC, LO-RANSAC) ignore it
+
+      n_jobs : number of threads used for the estimator x model fits (default: one per estimator). Inside process pools
+               (dataset_runner) use 1, so that the workers do not spawn threads on top of the pool
+
+      executor : an existing concurrent.futures executor to share (thread or process pool), if given n_jobs is ignored
+
+    Returns:
+      labels_ens : list with the mask of each model, 1-inlier ; 0-outlier
+    """
+    assert threshold is not None, "the ensemble needs the threshold of each model"
 
     img1, img2 = data["img1"], data["img2"]
 
@@ -305,49 +467,48 @@ def build_ensemble_mask(data, plot=False, verbose=True, type='H',threshold=None,
 
     points = extract_points(models, data)
 
-    tot_src = points[1]
-
     points = points[0]
-    
-    scores=[]
 
-    if threshold is not None: ens_models = [[] for _ in threshold]
-        
-    labels_ens=[]
+    if seeds is None: seeds = list(range(len(estimators)))
 
-    for i in range(len(models)):
-        outlier_indexes = []
+    model_points = []
 
+    for i in range(len(models)):
         if mask is not None:
             src = points["src_points"][i][np.where(mask[i]==1)]
             dst = points["dst_points"][i][np.where(mask[i]==1)]
+            idx = points["indices"][i][np.where(mask[i]==1)]
         else:
             src = points["src_points"][i]
             dst = points["dst_points"][i]
+            idx = points["indices"][i]
+        model_points.append((src, dst, idx))
+
+    # all the estimator x model fits are independent (and cv2 releases the GIL): they run on a thread pool,
+    # pool.map keeps the order of the jobs so the result does not depend on the scheduling
+    jobs = [(src, dst, threshold[i], method, seed, verbose)
+            for i, (src, dst, _) in enumerate(model_points) for method, seed in zip(estimators, seeds)]
+
+    # the jobs are given column by column to the module level function, so process pools can pickle them too
+    columns = list(zip(*jobs)) or [()] * 6
+    if executor is not None:
+        ens_residuals = list(executor.map(_fit_ensemble_member, *columns))
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs or max(len(estimators), 1)) as pool:
+            ens_residuals = list(pool.map(_fit_ensemble_member, *columns))
 
-        if threshold is not None:
-            for method in ['LMEDS_FM','RANSAC_FM','GC-RANSAC',"LO-RANSAC"]:#,list(FITTING_ALGS.keys())[3:]:
-                M, _ = verify_FM(src, dst, threshold=threshold[i], method=method.upper())
-                ens_models[i].append(compute_residuals_FM(src, dst, M))
-        else:
-            for method in ['LMEDS_FM','RANSAC_FM','GC-RANSAC',"LO-RANSAC"]:#list(FITTING_ALGS.keys())[3:]:
-                M, _ = verify_FM(src, dst, threshold=threshold, method=method.upper())
-                ens_models[i].append(compute_residuals_FM(src, dst, M))
+    labels_ens=[]
 
-        cv2_mask = np.where(np.sum(np.array(ens_models[i]), axis=0) /4 > threshold[i], 0, 1) #threshold[i]
+    for i, (src, dst, idx) in enumerate(model_points):
+        ens_models = np.stack(ens_residuals[i * len(estimators):(i + 1) * len(estimators)])  # (estimators, points)
 
-        src_outl = np.where(cv2_mask == 0)
+        cv2_mask = np.where(np.mean(ens_models, axis=0) > threshold[i], 0, 1)
 
-        outl = src[src_outl]
-        
         labels_ens.append(cv2_mask)
 
-        for out in outl:
-            for j, arr in enumerate(tot_src):
-                if np.array_equal(arr, out):
-                    outlier_indexes.append(j)
+        outlier_indexes = idx[cv2_mask == 0].tolist()
 
-        print("The outlier indices are", outlier_indexes)
+        if verbose: print("The outlier indices are", outlier_indexes)
 
         if plot:
             plt.figure()
@@ -358,6 +519,16 @@ def build_ensemble_mask(data, plot=False, verbose=True, type='H',threshold=None,
     return labels_ens
 
 
+def compose_scene_mask(model_masks, indices, num_of_points):
+    """Given the per-model masks and the per-model row indices (points["indices"] of extract_points) it returns the scene
+    level mask of shape (N,M): at position i,j there is the value of the mask of model j for point i, 0 if point i is not a
+    point of model j."""
+    scene_mask = np.zeros((num_of_points, len(model_masks)), dtype=np.uint8)
+    for j, (model_mask, idx) in enumerate(zip(model_masks, indices)):
+        scene_mask[idx, j] = np.ravel(model_mask)
+    return scene_mask
+
+
 def build_residual_matrix(data, plot=False, verbose=False, type='H', method="lmeds", threshold=None,
                           return_inl_out=False, ensemble=False, show_correct=False, metric="sampson"):
     """Given the data it automatically fit the homography or the fundamental matrix for each model and returns the residual matrix.
@@ -381,9 +552,12 @@ def build_residual_matrix(data, plot=False, verbose=False, type='H', method="lme
 
     img1, img2 = data["img1"], data["img2"]
 
-    outliers, models = vi.group_models(data)["outliers"], vi.group_models(data)["models"]
+    with ins.stage("group_models"):
+        groups = vi.group_models(data)
+    outliers, models = groups["outliers"], groups["models"]
 
-    points = extract_points(models, data)
+    with ins.stage("extract_points"):
+        points = extract_points(models, data)
 
     tot_src = points[1]
 
@@ -401,11 +575,11 @@ def build_residual_matrix(data, plot=False, verbose=False, type='H', method="lme
 
     models_outliers = []
 
+    fitted_FM = []
+
     if threshold is not None and ensemble: ens_models = [[] for _ in threshold]
 
     for i in range(len(models)):
-        outlier_indexes = []
-
         src = points["src_points"][i]
         dst = points["dst_points"][i]
 
@@ -416,52 +590,39 @@ def build_residual_matrix(data, plot=False, verbose=False, type='H', method="lme
             else:
                 cv2_M, cv2_mask = verify_H(src, dst, threshold=threshold, method=method.upper(), verbose=verbose)
 
-            src_outl = np.where(cv2_mask == 0)
-
-            outl = src[src_outl]
-
-            for out in outl:
-                for j, arr in enumerate(tot_src):
-                    if np.array_equal(arr, out):
-                        outlier_indexes.append(j)
-
         elif type == 'FM':
 
             if threshold is not None:
                 cv2_M, cv2_mask = verify_FM(src, dst, threshold=threshold[i], method=method.upper(), verbose=verbose)
             else:
                 cv2_M, cv2_mask = verify_FM(src, dst, threshold=threshold, method=method.upper(), verbose=verbose)
-
-            src_outl = np.where(cv2_mask == 0)
-
-            outl = src[src_outl]
-
-            for out in outl:
-                for j, arr in enumerate(tot_src):
-                    if np.array_equal(arr, out):
-                        outlier_indexes.append(j)
         else:
             warnings.warn("The given type is wrong. Types:\n'H'\n'FM'")
             return
 
+        with ins.stage("outlier_indices"):
+            outlier_indexes = points["indices"][i][np.ravel(cv2_mask) == 0].tolist()
+
         if verbose:
             print("the total number of point is: ", len(src))
             print("The indexes of outlier points are:", outlier_indexes)
 
         if plot:
-            # random_color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-            plt.figure()
+            with ins.stage("plot"):
+                # random_color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+                plt.figure()
 
-            # color[i % len(color)]
+                # color[i % len(color)]
 
-            draw_matches(img1, img2, src, dst, matchColor=(255, 0, 0), mask=1 - cv2_mask, H=cv2_M, show_correct=show_correct)
-            plt.grid(False)
-            plt.show()
+                draw_matches(img1, img2, src, dst, matchColor=(255, 0, 0), mask=1 - cv2_mask, H=cv2_M, show_correct=show_correct)
+                plt.grid(False)
+                plt.show()
 
         if type == 'H':
-            residual_matrix[:, i] = compute_residual(tot_src, tot_dst, cv2_M)
+            with ins.stage("residuals"):
+                residual_matrix[:, i] = compute_residual(tot_src, tot_dst, cv2_M)
         elif type == 'FM':
-            residual_matrix[:, i] = compute_residuals_FM(tot_src, tot_dst, cv2_M, metric)
+            fitted_FM.append(cv2_M)
 
         labs, counts = np.unique(cv2_mask, return_counts=True)
 
@@ -471,6 +632,16 @@ def build_residual_matrix(data, plot=False, verbose=False, type='H', method="lme
         else:
             models_outliers.append(len(cv2_mask))
 
+        ins.event("model", model=i, method=method.upper(), points=len(src), inliers=len(src) - models_outliers[-1],
+                  outliers=models_outliers[-1])
+        ins.count("models")
+        ins.count("points", len(src))
+
+    if type == 'FM':
+        # all the models of the scene are evaluated in a single call
+        with ins.stage("residuals"):
+            residual_matrix[:, :] = compute_residuals_FM(tot_src, tot_dst, np.array(fitted_FM), metric)
+
     if return_inl_out:
         return residual_matrix, models_inliers, models_outliers
     else:
@@ -541,15 +712,41 @@ def row_compuation(row, fuzzifier=2):
     return new_row
 
 
-def build_partition_matrix(residual_matrix):
-    """ Build the partition Matrix given the residual matrix"""
+def build_partition_matrix(residual_matrix, fuzzifier=2, dtype=np.float64, log_domain=True):
+    """ Build the partition Matrix given the residual matrix, all the rows at once. Same values of row_compuation:
+    u_ij = 1 / sum_k (r_ij / r_ik)^(2/(fuzzifier-1)) = r_ij^-p / sum_k r_ik^-p   with p = 2/(fuzzifier-1)
 
-    partition_matrix = np.zeros(residual_matrix.shape)
+    Args:
+
+      residual_matrix : a numpy array of shape (N,M), N=number of points, M=number of models
+      fuzzifier : fuzzifier of the partition, must be > 1
+      dtype : dtype of the returned matrix (np.float64 or np.float32), the computation is always done in float64
+      log_domain : if True the normalization is done with a log-sum-exp, no overflow/underflow for tiny or huge residuals
+
+    Returns:
+      partition_matrix : numpy array of shape (N,M). A row with one or more residuals exactly equal to 0 gets crisp membership:
+                         the membership is shared equally by the models with zero residual, 0 for the others.
+    """
+    assert fuzzifier > 1, "the fuzzifier must be greater than 1"
+    residual_matrix = np.asarray(residual_matrix, dtype=np.float64)
+    p = 2 / (fuzzifier - 1)
+
+    zeros = residual_matrix == 0
+    crisp_rows = zeros.any(axis=1)
+
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        if log_domain:
+            log_w = -p * np.log(residual_matrix)
+            log_w_max = np.max(log_w, axis=1, keepdims=True)
+            log_w_max[crisp_rows] = 0
+            w = np.exp(log_w - log_w_max)
+        else:
+            w = residual_matrix ** -p
+        partition_matrix = w / np.sum(w, axis=1, keepdims=True)
 
-    for i in range(residual_matrix.shape[0]):
-        partition_matrix[i, :] = row_compuation(residual_matrix[i, :])
+    partition_matrix[crisp_rows] = zeros[crisp_rows] / np.sum(zeros[crisp_rows], axis=1, keepdims=True)
 
-    return partition_matrix
+    return partition_matrix.astype(dtype, copy=False)
 
 
 def residual_H1_wrt_H2(src, H1, H2):
@@ -566,13 +763,66 @@ def residual_H1_wrt_H2(src, H1, H2):
     return residuals
 
 
-def point_belongs_to_model(models, type='H', method='sampson', threshold=1):
+def model_points(models):
+    """Given the models (as returned by vi.group_models) it returns all their points stacked, model after model.
+
+    Returns:
+      src_points : numpy array (N,2) of the points in the first image
+      dst_points : numpy array (N,2) of the points in the second image
+      labels : numpy array (N,) with the model of each point, i + 1 for the points of models[i]
+    """
+    src_points = np.concatenate([np.column_stack((m[0], m[1])) for m in models]).astype(np.float64)
+    dst_points = np.concatenate([np.column_stack((m[2], m[3])) for m in models]).astype(np.float64)
+    labels = np.repeat(np.arange(1, len(models) + 1), [len(m[0]) for m in models])
+    return src_points, dst_points, labels
+
+
+def cross_model_residuals(src_points, dst_points, M, type='H', method='sampson'):
+    """Residual of every point w.r.t. every fitted model, in one batched computation.
+
+    Args:
+      src_points, dst_points : numpy arrays (N,2) of corresponding points
+      M : list (or (K,3,3) array) of the fitted homographies / fundamental matrices
+      type : 'H' (reprojection error) or 'FM' (residual given by method, 'sampson' or 'sed')
+
+    Returns:
+      residuals : numpy array (N,K). At position i,j there is the residual of point i w.r.t. the model j
+    """
+    if type == 'H':
+        return batch_reprojection_residual(src_points, dst_points, np.array(M))
+    return compute_residuals_FM(src_points, dst_points, np.array(M), method)
+
+
+def inlier_to_other_model(residuals, labels, threshold):
+    """Boolean (N,K) matrix, True where the point i is an inlier (residual < threshold) of the model j and j is not the
+    model of the point (labels[i] != j + 1). threshold is a single value or one value for each model."""
+    residuals = np.asarray(residuals)
+    own = np.asarray(labels)[:, None] == np.arange(1, residuals.shape[1] + 1)[None, :]
+    return (residuals < np.asarray(threshold)) & ~own
+
+
+def overlap_statistics(inlier_other, labels):
+    """(K,K) matrix of counts, at position i,j the number of points of model i that are inliers of model j (i != j)."""
+    own = np.asarray(labels)[:, None] == np.arange(1, inlier_other.shape[1] + 1)[None, :]
+    return own.T.astype(np.int64) @ inlier_other.astype(np.int64)
+
+
+def point_belongs_to_model(models, type='H', method='sampson', threshold=1, return_matrix=False):
+    """Fits each model on its points and finds the points that are inliers of another model.
+
+    Returns:
+      result : dictionary, "model{i+1}_point{j+1}" -> indices (within model i) of the points of model i that are inliers of
+               model j (see extract_significant_point_idx)
+      with return_matrix instead:
+      residuals : numpy array (N,K), residual of every point of the models (stacked as in model_points) w.r.t. every model
+      inlier_other : boolean numpy array (N,K), see inlier_to_other_model
+      overlap : numpy array (K,K), see overlap_statistics
+    """
     Ms = []
-    masks = []
 
     for i in range(len(models)):
-        src_points = np.array(list(zip(models[i][0], models[i][1])))
-        dst_points = np.array(list(zip(models[i][2], models[i][3])))
+        src_points = np.column_stack((models[i][0], models[i][1]))
+        dst_points = np.column_stack((models[i][2], models[i][3]))
         if type == 'H':
             M, mask = verify_cv2_H(src_points, dst_points)
         elif type == 'FM':
@@ -580,11 +830,18 @@ def point_belongs_to_model(models, type='H', method='sampson', threshold=1):
         else:
             warnings.warn("Attenzione: nessun tipo valido rilevato. Types: 'H' o 'FM'")
             return
-        masks.append(mask)
         Ms.append(M)
 
-    res = compute_residual_different_model(Ms, models, type, method)
-    return extract_significant_point_idx(res, threshold)
+    src_points, dst_points, labels = model_points(models)
+    residuals = cross_model_residuals(src_points, dst_points, Ms, type, method)
+    inlier_other = inlier_to_other_model(residuals, labels, threshold)
+
+    if return_matrix:
+        return residuals, inlier_other, overlap_statistics(inlier_other, labels)
+
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(models) + 1)[1:])))
+    return {"model" + str(i + 1) + "_point" + str(j + 1): np.nonzero(inlier_other[offsets[i]:offsets[i + 1], j])[0].tolist()
+            for i in range(len(models)) for j in range(len(models)) if i != j}
 
 
 def extract_significant_point_idx(res, threshold):
@@ -592,28 +849,23 @@ def extract_significant_point_idx(res, threshold):
     for i in range(len(res)):
         for j in range(len(res[i])):
             if i != j:
-                result["model" + str(i + 1) + "_point" + str(j + 1)] = [k for k in range(len(res[i][j])) if
-                                                                        res[i][j][k] < threshold]
+                result["model" + str(i + 1) + "_point" + str(j + 1)] = np.nonzero(np.asarray(res[i][j]) < threshold)[0].tolist()
 
     return result
 
 
 def compute_residual_different_model(M, models, type, method):
-    residuals = np.zeros((len(models), len(M)), dtype=object)
+    """Residuals of the points of each model w.r.t. each of the models M, as an object grid: residuals[i][j] is the array
+    of the residuals of the points of model i w.r.t. M[j] ([0] for i == j). All the residuals come from a single
+    cross_model_residuals call."""
+    src_points, dst_points, labels = model_points(models)
+    dense = cross_model_residuals(src_points, dst_points, M, type, method)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(models) + 1)[1:])))
 
+    residuals = np.zeros((len(models), len(M)), dtype=object)
     for i in range(len(models)):
         for j in range(len(M)):
-            if i == j:
-                residuals[i][j] = [0]
-            else:
-                if type == 'H':
-                    residuals[i][j] = compute_residual(list(zip(models[i][0], models[i][1])),
-                                                       list(zip(models[i][2], models[i][3])),
-                                                       M[j])
-                elif type == 'FM':
-                    residuals[i][j] = compute_residuals_FM(list(zip(models[i][0], models[i][1])),
-                                                           list(zip(models[i][2], models[i][3])),
-                                                           M[j], method)
+            residuals[i][j] = [0] if i == j else dense[offsets[i]:offsets[i + 1], j]
 
     return residuals
 
@@ -760,50 +1012,130 @@ def analyze_reprojection_error(data, thresholds=None, method="LMEDS", type='H'):
     return average_errors
 
 
-def compute_sampson_distance(src_points, dst_points, F):
-    src_ = np.array(src_points)
-    dst_ = np.array(dst_points)
-    F = np.array(F, dtype=np.float64)
+def to_homogeneous(points, dtype=np.float64):
+    """Given N 2D points it returns them in homogeneous coordinates as a (N,3) array of the given dtype."""
+    points = np.asarray(points, dtype=dtype).reshape(-1, 2)
+    return np.hstack((points, np.ones((points.shape[0], 1), dtype=dtype)))
 
-    # Convert source point to homogeneous coordinates
-    src_points_hom = np.array([np.append(src_point, 1) for src_point in src_], dtype=np.float64)
 
-    # Convert destination points to homogeneous coordinates
-    dst_points_hom = np.array([np.append(dst_point, 1) for dst_point in dst_], dtype=np.float64)
+def batch_sampson_distance(src_points, dst_points, Fs, dtype=np.float64):
+    """Given N correspondences and a stack of K fundamental matrices, it returns the Sampson distance of every point
+    w.r.t. every matrix in a single pass. The value is the same returned by cv2.sampsonDistance.
+
+    Args:
+      src_points: Source points as a NumPy array (shape: Nx2).
+      dst_points: Destination points as a NumPy array (same shape as src_points).
+      Fs: fundamental matrices, shape (K,3,3) or (3,3) for a single matrix.
+      dtype: np.float64 (default) or np.float32, precision used for the whole computation.
 
-    return np.array([cv2.sampsonDistance(src_point_hom, dst_point_hom, F) for src_point_hom, dst_point_hom in
-                     zip(src_points_hom, dst_points_hom)])
+    Returns:
+      residuals : numpy array of shape (N,K). At position i,j there is the Sampson distance of point i w.r.t. Fs[j]
+    """
+    src_hom = to_homogeneous(src_points, dtype)
+    dst_hom = to_homogeneous(dst_points, dtype)
+    Fs = np.asarray(Fs, dtype=dtype).reshape(-1, 3, 3)
 
+    # epilines F x1 and F^T x2 for every (model, point) pair, shape (K,N,3)
+    Fx1 = src_hom @ Fs.transpose(0, 2, 1)
+    Ftx2 = dst_hom @ Fs
 
-def distance_point_line(ps, ls):
-    return np.array([np.dot(np.array(l), np.array(p).T) / np.sqrt(l[0] ** 2 + l[1] ** 2) for l, p in zip(ls, ps)])
+    x2tFx1 = np.sum(Fx1 * dst_hom, axis=2)
+    denominator = Fx1[..., 0] ** 2 + Fx1[..., 1] ** 2 + Ftx2[..., 0] ** 2 + Ftx2[..., 1] ** 2
 
+    return (x2tFx1 ** 2 / denominator).T
 
-def compute_SED(src_points, dst_points, F):
-    src_ = np.array(src_points)
-    dst_ = np.array(dst_points)
 
-    # Convert source point to homogeneous coordinates
-    src_points_hom = np.array([np.append(src_point, 1) for src_point in src_])
+def batch_reprojection_residual(src_points, dst_points, Hs, dtype=np.float64):
+    """Given N correspondences and a stack of K homographies, it returns the reprojection error of every point w.r.t.
+    every homography in a single pass, the same value of compute_residual.
 
-    # Convert destination points to homogeneous coordinates
-    dst_points_hom = np.array([np.append(dst_point, 1) for dst_point in dst_])
+    Args:
+      src_points: Source points as a NumPy array (shape: Nx2).
+      dst_points: Destination points as a NumPy array (same shape as src_points).
+      Hs: homographies, shape (K,3,3) or (3,3) for a single matrix.
+      dtype: np.float64 (default) or np.float32, precision used for the whole computation.
 
-    # Compute the epilines of the source points
-    ep_ls = np.array([np.dot(F.T, dst_point_hom.T) for dst_point_hom in dst_points_hom])
+    Returns:
+      residuals : numpy array of shape (N,K). At position i,j there is the residual of point i w.r.t. Hs[j]
+    """
+    src_hom = to_homogeneous(src_points, dtype)
+    dst = np.asarray(dst_points, dtype=dtype).reshape(-1, 2)
+    Hs = np.asarray(Hs, dtype=dtype).reshape(-1, 3, 3)
 
-    # Compute the epilines of the destination points
-    ep_ls_prime = np.array([np.dot(F, src_point_hom.T) for src_point_hom in src_points_hom])
+    projected = src_hom @ Hs.transpose(0, 2, 1)  # (K,N,3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projected = projected[..., :2] / projected[..., 2:]
 
-    return np.sqrt(
-        distance_point_line(src_points_hom, ep_ls) ** 2 + distance_point_line(dst_points_hom, ep_ls_prime) ** 2)
+    return np.sqrt(np.sum((projected - dst) ** 2, axis=2)).T
+
+
+def compute_sampson_distance(src_points, dst_points, F, dtype=np.float64):
+    """Sampson distance of each pair of points. If F is a single (3,3) matrix it returns an array of shape (N,),
+    if F is a stack of K matrices it returns the (N,K) residual block (see batch_sampson_distance)."""
+    residuals = batch_sampson_distance(src_points, dst_points, F, dtype=dtype)
+    if np.ndim(F) == 2:
+        return residuals[:, 0]
+    return residuals
+
+
+def distance_point_line(ps, ls):
+    """Signed distance of the homogeneous points ps from the lines ls, row by row. Works on any (..., 3) arrays."""
+    ps = np.asarray(ps)
+    ls = np.asarray(ls)
+    return np.sum(ls * ps, axis=-1) / np.sqrt(ls[..., 0] ** 2 + ls[..., 1] ** 2)
+
+
+def batch_SED(src_points, dst_points, Fs, return_sides=False, dtype=np.float64):
+    """Given N correspondences and a stack of K fundamental matrices, it returns the symmetric epipolar distance of every
+    point w.r.t. every matrix in a single pass.
+
+    Args:
+      src_points: Source points as a NumPy array (shape: Nx2).
+      dst_points: Destination points as a NumPy array (same shape as src_points).
+      Fs: fundamental matrices, shape (K,3,3) or (3,3) for a single matrix.
+      return_sides: if True also the two one-sided distances are returned.
+      dtype: np.float64 (default) or np.float32, precision used for the whole computation.
+
+    Returns:
+      sed : numpy array of shape (N,K). At position i,j there is the SED of point i w.r.t. Fs[j]
+      d_src, d_dst (only if return_sides) : numpy arrays of shape (N,K), distance of the src point from the epiline F^T x2
+                                            and distance of the dst point from the epiline F x1
+    """
+    src_hom = to_homogeneous(src_points, dtype)
+    dst_hom = to_homogeneous(dst_points, dtype)
+    Fs = np.asarray(Fs, dtype=dtype).reshape(-1, 3, 3)
+
+    # epilines of the destination points in the first image and of the source points in the second one, shape (K,N,3)
+    ep_ls = dst_hom @ Fs
+    ep_ls_prime = src_hom @ Fs.transpose(0, 2, 1)
+
+    d_src = np.abs(distance_point_line(src_hom, ep_ls)).T
+    d_dst = np.abs(distance_point_line(dst_hom, ep_ls_prime)).T
+
+    sed = np.sqrt(d_src ** 2 + d_dst ** 2)
+    if return_sides:
+        return sed, d_src, d_dst
+    return sed
+
+
+def compute_SED(src_points, dst_points, F, return_sides=False, dtype=np.float64):
+    """Symmetric epipolar distance of each pair of points. If F is a single (3,3) matrix the result has shape (N,),
+    if F is a stack of K matrices it has shape (N,K) (see batch_SED)."""
+    result = batch_SED(src_points, dst_points, F, return_sides=return_sides, dtype=dtype)
+    if np.ndim(F) == 2:
+        if return_sides:
+            return tuple(r[:, 0] for r in result)
+        return result[:, 0]
+    return result
 
 
-def compute_residuals_FM(src_points, dst_points, F, method='sampson'):
+def compute_residuals_FM(src_points, dst_points, F, method='sampson', dtype=np.float64):
+    """Residuals of the correspondences w.r.t. the fundamental matrix F. F can also be a stack of K matrices, in that case
+    the (N,K) residual block is returned."""
     if method == 'sampson':
-        return compute_sampson_distance(src_points, dst_points, F)
+        return compute_sampson_distance(src_points, dst_points, F, dtype=dtype)
     if method == 'sed':
-        return compute_SED(src_points, dst_points, F)
+        return compute_SED(src_points, dst_points, F, dtype=dtype)
 
 
 def plot_forward_search(src_points, dst_points, title='', type='H'):
@@ -818,9 +1150,11 @@ def plot_forward_search(src_points, dst_points, title='', type='H'):
 
     unique, counts = np.unique(mask, return_counts=True)
 
-    # Perform forward search
-    _, threshold = forward_search(residuals=scores,
-                                  initial_m0=len(mask) - counts[np.where(unique == 1)][0] + 1)
+    # Perform forward search, the trajectory carries the sorted scores and the subset monitored by the search
+    _, threshold, trajectory = forward_search(residuals=scores,
+                                              initial_m0=len(mask) - counts[np.where(unique == 1)][0] + 1,
+                                              return_trajectory=True)
+    scores = trajectory["sorted_residuals"]
 
     # Plot actual scores
     plt.plot(range(1, len(scores) + 1), scores)
@@ -838,6 +1172,8 @@ def plot_forward_search(src_points, dst_points, title='', type='H'):
     plt.plot(x_values, f_max(x_values), 'g--', label='Upper Envelope')
 
     plt.axhline(threshold, linestyle='--')
+    if len(trajectory["subset_size"]):
+        plt.axvline(trajectory["subset_size"][-1], color='k', linestyle=':', label='Final subset')
 
     plt.xlabel('Number of Correspondences')
     plt.ylabel('Residual Scores')
@@ -40,7 +40,8 @@ def group_models(data):
 
         models.append(model)
         
-    to_ret={'outliers': outliers , "models" : models}
+    # column indices in data["data"] of the outliers and of the points of each model
+    to_ret={'outliers': outliers , "models" : models, "outliers_indices": groups[0][0], "indices": [groups[i][0] for i in range(1,max_mod+1)]}
     
     return to_ret
 